@@ -11,30 +11,126 @@ More info here::
 
     https://msdn.microsoft.com/en-us/library/dd355398.aspx
 """
+import collections
+import concurrent.futures
+import copy
+import functools
 import logging
+import io
+import threading
+import urllib.parse
+import uuid
 import warnings
+import weakref
 from urllib3.exceptions import InsecureRequestWarning
 
 import requests
 import requests_ntlm
 import zeep
 import zeep.cache
+import zeep.exceptions
+import zeep.loader
+import zeep.transports
+from zeep.wsdl.utils import etree_to_string
 
+from . import cassettes
 from . import config  # noqa
+from . import decoding
 from . import exceptions
+from . import mirror as _mirror
+from . import profiling
+from . import schemas
+from . import store
 from ._metadata import __version__, __version_info__  # noqa
 from .constants import (
+    CASSETTE_RECORD,
+    CASSETTE_REPLAY,
+    COMPRESSION_FULL,
+    COMPRESSION_OFF,
+    COMPRESSION_RESPONSE,
+    DEFAULT_COMPRESS_MIN_SIZE,
+    DEFAULT_IDENTITY_MAP_SIZE,
+    DEFAULT_IDENTITY_MAP_TTL,
+    DEFAULT_MAX_CRITERIA_LENGTH,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_SINGLE_FLIGHT_FUNCTIONS,
+    DEFAULT_UPDATE_BATCH_SIZE,
     DEFAULT_WSDL_CACHE_EXPIRATION,
     CODEUNIT,
+    ON_ERROR_BISECT,
+    ON_ERROR_RAISE,
+    ON_ERROR_REPORT,
     PAGE,
     ReadMultiple,
     CreateMultiple,
+    Read,
+    ReadByRecId,
+    GetRecIdFromKey,
+    UpdateMultiple,
+    Delete,
+)
+from .cache import IdentityMap
+from .plugins import NamespaceRewritePlugin, RemoveNamespacePlugin  # noqa
+from .singleflight import SingleFlight, freeze
+from .stats import Stats
+from .transports import NAVTransport, process_spooled_reply
+from .utils import (
+    chunk_filter_criteria,
+    make_value_converters,
+    prefetch_iter,
+    to_builtins,
 )
-from .plugins import RemoveNamespacePlugin  # noqa
-from .utils import to_builtins
 
 logger = logging.getLogger('nav')
 
+GetManyResult = collections.namedtuple('GetManyResult', ['found', 'missing'])
+CreateMultipleReport = collections.namedtuple(
+    'CreateMultipleReport',
+    ['created', 'failed'],
+)
+UpdateMultipleReport = collections.namedtuple(
+    'UpdateMultipleReport',
+    ['updated', 'failed'],
+)
+DeleteReport = collections.namedtuple('DeleteReport', ['deleted', 'failed'])
+FailedEntry = collections.namedtuple('FailedEntry', ['index', 'entry', 'error'])
+
+
+class PreparedCall:
+    """A WS call serialized by `NAV.prepare`, that can be executed many times"""
+
+    def __init__(
+        self,
+        nv,
+        srvc,
+        service_name,
+        operation,
+        envelope,
+        track_writes=None,
+    ):
+        self.nv = nv
+        self.service_name = service_name
+        self.operation = operation
+        self._srvc = srvc
+        self._envelope = envelope
+        self._track_writes = track_writes
+
+    def __repr__(self):
+        return '<PreparedCall {}.{}>'.format(self.service_name, self.operation)
+
+    @property
+    def message(self):
+        """The serialized request envelope"""
+        return self._envelope[0]
+
+    def execute(self):
+        """Send the request and return the result as python built-in types"""
+        data = self.nv._call_prepared(self._srvc, self.operation, self._envelope)
+        if self._track_writes is not None:
+            self._track_writes(data)
+        return data
+
 
 class NAV:
     """Client to make requests to NAV web services
@@ -50,6 +146,82 @@ class NAV:
             How long WSDL files are cached in memory. Set to something falsy like False/0/None to disable this functionality. Defaults to 1 hour
         verify_certificate:
             Whether or not to verify certificate for HTTPS requests. Defaults to True
+        max_workers:
+            Maximum amount of concurrent requests made by methods that fan out
+            over several requests, e.g. `read_multiple_all_companies`.
+            Defaults to 8
+        compression:
+            HTTP compression to negotiate with NAV. One of None (the defaults
+            of the requests library, which currently ask for gzip/deflate
+            compressed responses), "off" (ask for uncompressed responses),
+            "response" (ask for gzip/deflate compressed responses, whatever
+            the defaults) or "full" (additionally gzip request bodies of at
+            least `compress_min_size` bytes, which the server must accept).
+            Transferred byte counts are kept in `NAV.stats`
+        compress_min_size:
+            Smallest request body to compress when `compression` is "full".
+            Defaults to 8 KiB
+        spool_threshold:
+            Stream response bodies larger than this many bytes into a temporary
+            file on disk and parse them from there, rather than keeping the
+            whole body in memory. Defaults to None, i.e. no spooling
+        max_response_size:
+            Raise `nav.exceptions.ResponseTooLarge` instead of reading a
+            response body larger than this many bytes. Defaults to no limit
+        schema_cache_dir:
+            Directory in which to keep fully parsed WSDL definitions, so that
+            later processes can load them instead of parsing the WSDL again.
+            Defaults to None, i.e. parse the WSDL in every process
+        decode_workers:
+            Amount of worker processes to parse responses in, which frees up
+            the calling process while big responses are decoded. Defaults to
+            None, i.e. parse responses in the calling process. Call `close`
+            to stop the workers when done with the client. Responses spooled
+            because of `spool_threshold` are still parsed in the calling
+            process. Requires Python 3.7+, on Python 3.6 a `RuntimeWarning`
+            is issued and responses are parsed in the calling process
+        cassette:
+            Path of a cassette file to record HTTP traffic to, or replay it
+            from, see `nav.cassettes`
+        cassette_mode:
+            "record" to append all requests and responses to `cassette`, or
+            "replay" to serve responses from it without contacting NAV
+        replay_latency:
+            Multiplier of the recorded response times to wait for when
+            replaying a cassette. Defaults to 0, i.e. respond immediately
+        replay_fallback:
+            When replaying, serve the first response recorded for the same
+            URL and SOAP action to requests whose body was never recorded,
+            e.g. a ReadMultiple with other filters. Defaults to False, i.e.
+            raise `nav.exceptions.InteractionNotRecorded`
+        single_flight_functions:
+            Page and codeunit functions for which concurrent calls with the
+            same arguments share a single request to NAV. Names may be
+            qualified with the service, e.g. "IntegrationEntry.GetPrices".
+            Only list functions without side effects. Defaults to
+            ReadMultiple. Pass an empty set to disable
+        decode_policy:
+            How to decode decimal and date fields of results, e.g.
+            `{'decimal': 'float', 'dates': 'iso'}` for JSON ready results.
+            See `nav.utils.make_value_converters`. Defaults to None, i.e.
+            `decimal.Decimal` and `datetime` objects
+        identity_map_size:
+            Maximum amount of page entries that `read` and `read_by_key` keep
+            in memory, keyed on their NAV `Key`. 0 disables the cache.
+            Defaults to 1024
+        identity_map_ttl:
+            Seconds that entries are served from memory by `read` and
+            `read_by_key`. Defaults to 60
+        envelope_cache_size:
+            Amount of serialized request envelopes to keep, so that repeated
+            calls with the same arguments skip building, validating and
+            serializing the envelope, including the egress of any zeep
+            plugins. Defaults to 0, i.e. no caching. See also `prepare`
+        share_schemas:
+            Share parsed WSDL definitions with all other `NAV` instances of
+            the process that fetch byte-identical WSDLs, e.g. the same page
+            in several tenants or companies. See `nav.store`. Defaults to
+            True
     """
 
     def __init__(
@@ -59,14 +231,77 @@ class NAV:
         password,
         cache_expiration=DEFAULT_WSDL_CACHE_EXPIRATION,
         verify_certificate=True,
+        max_workers=DEFAULT_MAX_WORKERS,
+        compression=None,
+        compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+        spool_threshold=None,
+        max_response_size=None,
+        schema_cache_dir=None,
+        decode_workers=None,
+        cassette=None,
+        cassette_mode=None,
+        replay_latency=0,
+        replay_fallback=False,
+        single_flight_functions=DEFAULT_SINGLE_FLIGHT_FUNCTIONS,
+        decode_policy=None,
+        identity_map_size=DEFAULT_IDENTITY_MAP_SIZE,
+        identity_map_ttl=DEFAULT_IDENTITY_MAP_TTL,
+        envelope_cache_size=0,
+        share_schemas=True,
     ):
+        self.validate_compression(compression)
+        self.validate_cassette_mode(cassette_mode)
+        make_value_converters(decode_policy)
+
         self.base_url = base_url
         self.username = username
         self.password = password
         self.cache_expiration = cache_expiration
         self.verify_certificate = verify_certificate
+        self.max_workers = max_workers
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+        self.spool_threshold = spool_threshold
+        self.max_response_size = max_response_size
+        self.schema_cache_dir = schema_cache_dir
+        self.decode_workers = decode_workers
+        self.cassette = cassette
+        self.cassette_mode = cassette_mode
+        self.replay_latency = replay_latency
+        self.replay_fallback = replay_fallback
+        self.single_flight_functions = frozenset(single_flight_functions)
+        self.decode_policy = decode_policy
+        self.share_schemas = share_schemas
+        self.stats = Stats()
         self._service_cache = {}
 
+        # NOTE: The session, the zeep clients and the lock guarding them are
+        # shared with any NAV instances derived through `for_companies`, as
+        # the WSDL definitions are the same for every company.
+        self._client_cache = {}
+        self._client_lock = threading.RLock()
+        self._session = self._make_session()
+        self._single_flight = SingleFlight()
+        # Page entries by `Key`, and the `Key` of entries read by their
+        # primary key fields
+        self._records = IdentityMap(identity_map_size, identity_map_ttl)
+        self._record_keys = IdentityMap(identity_map_size, identity_map_ttl)
+        self._envelopes = IdentityMap(envelope_cache_size, None)
+
+        if self.decode_workers and decoding.SUPPORTED:
+            self._decode_pool = decoding.make_pool(self.decode_workers)
+        else:
+            if self.decode_workers:
+                warnings.warn(
+                    'decode_workers requires Python 3.7+, parsing responses '
+                    'in the calling process',
+                    RuntimeWarning,
+                    stacklevel=2,
+                )
+            self._decode_pool = None
+        # Pickled WSDL definitions to send to the decode workers, per client
+        self._decode_schemas = weakref.WeakKeyDictionary()
+
         # Ignore warning in case we've actively disabled
         # certificate verification.
         if self.verify_certificate is False:
@@ -84,6 +319,51 @@ class NAV:
             self.base_url = self.base_url[:-1]
         return '/'.join([self.base_url, *args])
 
+    @property
+    def _cache_scope(self):
+        """Identifies the company the cached results of this instance are for"""
+        return self.base_url.rstrip('/')
+
+    def _make_company_base_url(self, company):
+        head, sep, _ = self.base_url.rstrip('/').rpartition('/WS/')
+        if not sep:
+            raise ValueError(
+                "Can't determine the company part of base URL `{}`"
+                .format(self.base_url)
+            )
+        return ''.join([head, sep, urllib.parse.quote(company, safe='')])
+
+    def _make_session(self):
+        session = requests.Session()
+        session.verify = self.verify_certificate
+        session.auth = requests_ntlm.HttpNtlmAuth(self.username, self.password)
+
+        # Allow as many pooled connections as we have concurrent workers,
+        # as requests otherwise discards connections beyond the default 10.
+        adapter_kw = dict(
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers,
+        )
+        if self.cassette_mode:
+            adapter = cassettes.make_adapter(
+                self.cassette_mode,
+                self.cassette,
+                self.base_url,
+                latency=self.replay_latency,
+                fallback=self.replay_fallback,
+                **adapter_kw
+            )
+        else:
+            adapter = requests.adapters.HTTPAdapter(**adapter_kw)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if self.compression in (COMPRESSION_RESPONSE, COMPRESSION_FULL):
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+        elif self.compression == COMPRESSION_OFF:
+            session.headers['Accept-Encoding'] = 'identity'
+        return session
+
     @staticmethod
     def _make_binding(endpoint_type, service_name):
         if endpoint_type == PAGE:
@@ -113,9 +393,40 @@ class NAV:
                 .format(s, allowed_values)
             )
 
+    @staticmethod
+    def validate_compression(s):
+        allowed_values = (
+            None,
+            COMPRESSION_OFF,
+            COMPRESSION_RESPONSE,
+            COMPRESSION_FULL,
+        )
+        if s not in allowed_values:
+            raise ValueError(
+                '`{}` is not a valid compression, must be one of {}'
+                .format(s, allowed_values)
+            )
+
+    @staticmethod
+    def validate_cassette_mode(s):
+        allowed_values = (None, CASSETTE_RECORD, CASSETTE_REPLAY)
+        if s not in allowed_values:
+            raise ValueError(
+                '`{}` is not a valid cassette mode, must be one of {}'
+                .format(s, allowed_values)
+            )
+
     @staticmethod
     def validate_supported_page_function(s):
-        allowed_values = (ReadMultiple, CreateMultiple)
+        allowed_values = (
+            ReadMultiple,
+            CreateMultiple,
+            UpdateMultiple,
+            Delete,
+            Read,
+            ReadByRecId,
+            GetRecIdFromKey,
+        )
         if s not in allowed_values:
             raise exceptions.UnsupportedPageFunction(
                 '`{}` is not a supported service function, must be one of {}'
@@ -130,20 +441,94 @@ class NAV:
         else:
             cache = None
 
-        session = requests.Session()
-        session.verify = self.verify_certificate
-        session.auth = requests_ntlm.HttpNtlmAuth(self.username, self.password)
-        transport = zeep.transports.Transport(session=session, cache=cache)
+        transport = NAVTransport(
+            session=self._session,
+            cache=cache,
+            stats=self.stats,
+            compress_requests=self.compression == COMPRESSION_FULL,
+            compress_min_size=self.compress_min_size,
+            spool_threshold=self.spool_threshold,
+            max_response_size=self.max_response_size,
+        )
 
         if 'settings' not in client_kwargs:
             client_kwargs['settings'] = zeep.Settings(strict=False)
 
-        return self._run_capture_500(
-            zeep.Client,
-            url,
-            transport=transport,
-            **client_kwargs
+        key = None
+        if self.share_schemas or self.schema_cache_dir:
+            wsdl, key = self._run_capture_500(
+                self._load_document,
+                url,
+                transport,
+                client_kwargs['settings'],
+            )
+        else:
+            wsdl = url
+
+        try:
+            client = self._run_capture_500(
+                zeep.Client,
+                wsdl,
+                transport=transport,
+                **client_kwargs
+            )
+        except Exception:
+            if key is not None:
+                store.default_store.release(key)
+            raise
+        if key is not None:
+            store.default_store.bind(client, key)
+        return client
+
+    def _load_document(self, url, transport, settings):
+        """Get the parsed WSDL document of a URL
+
+        Returns:
+            A tuple of the document and its key in the shared schema store,
+            which is None when the document is not shared
+        """
+        content = transport.load(url)
+
+        # NOTE: Shared documents are used by other instances too, possibly for
+        # other tenants, so they must not hold on to the credentials or the
+        # location of this one.
+        if self.share_schemas:
+            loader = self._make_loader_transport()
+        else:
+            loader = transport
+
+        def parse():
+            if self.schema_cache_dir:
+                document = schemas.load_or_parse_document(
+                    url,
+                    loader,
+                    settings,
+                    self.schema_cache_dir,
+                    content=content,
+                    stats=self.stats,
+                )
+            else:
+                document = schemas.parse_document(url, content, loader, settings)
+            if self.share_schemas:
+                document.location = None
+            return document
+
+        if not self.share_schemas:
+            return parse(), None
+
+        key, document, held = store.default_store.acquire(
+            content,
+            settings,
+            parse,
         )
+        self.stats.incr('schema_store_hits' if held else 'schema_store_misses')
+        return document, key
+
+    def _make_loader_transport(self):
+        """Transport without credentials for parsing shared WSDL documents"""
+        session = requests.Session()
+        session.verify = self.verify_certificate
+        return zeep.transports.Transport(session=session)
 
     def make_service(self, endpoint_type, service_name, **client_kwargs):
         """Create a WSDL service instance
@@ -163,15 +548,228 @@ class NAV:
         if service_cache_key in self._service_cache:
             srvc = self._service_cache[service_cache_key]
         else:
-            client = self._make_client(
+            client = self._get_client(
                 endpoint_type,
                 service_name,
                 **client_kwargs
             )
-            srvc = client.create_service(binding, client.wsdl.location)
+            srvc = client.create_service(
+                binding,
+                self._make_endpoint_url(endpoint_type, service_name),
+            )
             self._service_cache[service_cache_key] = srvc
         return srvc
 
+    def _get_client(self, endpoint_type, service_name, **client_kwargs):
+        client_cache_key = (endpoint_type, service_name, str(client_kwargs))
+
+        # Hold the lock while creating the client so that concurrent callers
+        # wait for the WSDL to be fetched once instead of fetching it each.
+        with self._client_lock:
+            if client_cache_key not in self._client_cache:
+                with profiling.phase(profiling.WSDL_LOAD):
+                    self._client_cache[client_cache_key] = self._make_client(
+                        endpoint_type,
+                        service_name,
+                        **client_kwargs
+                    )
+            return self._client_cache[client_cache_key]
+
+    def for_companies(self, companies):
+        """Get NAV instances for several companies
+
+        The returned instances share HTTP session and parsed WSDL definitions
+        with this instance, so only one WSDL fetch is made per service
+        regardless of the amount of companies.
+
+        Args:
+            companies:
+                Names of the companies, as they appear in NAV
+
+        Returns:
+            A dict mapping each company name to its NAV instance
+
+        """
+        navs = {}
+        for company in companies:
+            nv = copy.copy(self)
+            nv.base_url = self._make_company_base_url(company)
+            nv._service_cache = {}
+            navs[company] = nv
+        return navs
+
+    def _iter_concurrently(self, fun, items):
+        """Run `fun` for each item in a thread pool
+
+        Yields `(item, result)` tuples in order of completion.
+        """
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers,
+        ) as executor:
+            futures = {executor.submit(fun, item): item for item in items}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield futures[future], future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _call(self, srvc, operation, **kw):
+        """Run a WS operation on a service created by `make_service`
+
+        Returns the result as python built-in types.
+        """
+        if self._envelopes.max_size:
+            return self._call_prepared(
+                srvc,
+                operation,
+                self._get_envelope(srvc, operation, kw),
+            )
+
+        client = srvc._client
+        use_decode_pool = self._decode_pool is not None and not client.plugins
+
+        if not (
+            use_decode_pool or
+            client.transport.streaming or
+            profiling.is_active()
+        ):
+            return to_builtins(
+                getattr(srvc, operation)(**kw),
+                default=[],
+                decode_policy=self.decode_policy,
+            )
+
+        # Have zeep hand back the response untouched, so that it can be parsed
+        # here instead (or be timed separately when profiling).
+        with client.settings(raw_response=True):
+            response = getattr(srvc, operation)(**kw)
+        return self._process_response(srvc, operation, response)
+
+    def _make_envelope(self, srvc, operation, kw):
+        envelope, headers = srvc._binding._create(
+            operation,
+            (),
+            kw,
+            client=srvc._client,
+            options=srvc._binding_options,
+        )
+        return etree_to_string(envelope), headers
+
+    def _get_envelope(self, srvc, operation, kw):
+        key = (
+            srvc._client,
+            srvc._binding_options['address'],
+            operation,
+            freeze(kw),
+        )
+        envelope = self._envelopes.get(key)
+        if envelope is None:
+            self.stats.incr('envelope_cache_misses')
+            envelope = self._make_envelope(srvc, operation, kw)
+            self._envelopes.put(key, envelope)
+        else:
+            self.stats.incr('envelope_cache_hits')
+        return envelope
+
+    def _call_prepared(self, srvc, operation, envelope):
+        """Send a serialized envelope, see `_make_envelope`"""
+        message, headers = envelope
+        response = srvc._client.transport.post(
+            srvc._binding_options['address'],
+            message,
+            dict(headers),
+        )
+        return self._process_response(srvc, operation, response)
+
+    def _process_response(self, srvc, operation, response):
+        client = srvc._client
+        binding = srvc._binding
+        # NOTE: Spooled responses are parsed straight from their file in this
+        # process, as sending them to the decode workers would need the whole
+        # body in memory.
+        use_decode_pool = (
+            self._decode_pool is not None and
+            not client.plugins and
+            client.transport.spool_threshold is None
+        )
+
+        with profiling.phase(profiling.PARSE):
+            if use_decode_pool and response.status_code == 200:
+                decoded, data = self._decode_in_pool(
+                    client,
+                    binding,
+                    operation,
+                    response.content,
+                )
+                if decoded:
+                    return data
+            if client.transport.streaming and not use_decode_pool:
+                data = process_spooled_reply(client, binding, operation, response)
+            else:
+                data = binding.process_reply(client, binding.get(operation), response)
+        with profiling.phase(profiling.CONVERSION):
+            return to_builtins(data, default=[], decode_policy=self.decode_policy)
+
+    def _get_decode_schema(self, client):
+        with self._client_lock:
+            if client not in self._decode_schemas:
+                f = io.BytesIO()
+                try:
+                    schemas.dump_document(client.wsdl, f)
+                except Exception:
+                    logger.warning(
+                        'Unable to pickle WSDL definitions of %s, decoding '
+                        'its responses in this process',
+                        client.wsdl.location,
+                        exc_info=True,
+                    )
+                    self._decode_schemas[client] = None
+                else:
+                    self._decode_schemas[client] = (
+                        uuid.uuid4().hex,
+                        f.getvalue(),
+                    )
+            return self._decode_schemas[client]
+
+    def _decode_in_pool(self, client, binding, operation, content):
+        schema = self._get_decode_schema(client)
+        if schema is None:
+            return False, None
+        schema_key, schema_bytes = schema
+
+        def decode(schema_bytes):
+            return self._decode_pool.submit(
+                decoding.decode_reply,
+                schema_key,
+                schema_bytes,
+                client.settings.strict,
+                client.settings.xml_huge_tree,
+                binding.name.text,
+                operation,
+                content,
+                self.decode_policy,
+            ).result()
+
+        # Only send the definitions to workers that don't hold them yet
+        try:
+            decoded, data = decode(None)
+        except decoding.UnknownSchema:
+            self.stats.incr('worker_schema_transfers')
+            decoded, data = decode(schema_bytes)
+        if decoded:
+            self.stats.incr('worker_decoded_responses')
+        return decoded, data
+
+    def close(self):
+        """Stop the decode worker processes and close the HTTP session
+
+        NOTE: These are shared with instances created by `for_companies`.
+        """
+        if self._decode_pool is not None:
+            self._decode_pool.shutdown()
+        self._session.close()
+
     def meta(self, endpoint_type, service_name):
         """Get the definition of Codeunit or a Page
 
@@ -186,7 +784,35 @@ class NAV:
             endpoint_type,
             service_name,
         )
-        return client.wsdl._get_xml_document(client.wsdl.location)
+        # Shared documents hold on to the location and transport of the
+        # instance that parsed them, so fetch with those of this instance
+        return zeep.loader.load_external(
+            self._make_endpoint_url(endpoint_type, service_name),
+            client.transport,
+            settings=client.settings,
+        )
+
+    def _run_single_flight(self, endpoint_type, service_name, function, args, fun):
+        if not self.single_flight_functions.intersection([
+            function,
+            '{}.{}'.format(service_name, function),
+        ]):
+            return fun()
+
+        key = (
+            self._cache_scope,
+            endpoint_type,
+            service_name,
+            function,
+            freeze(args),
+            freeze(self.decode_policy),
+        )
+        data, shared = self._single_flight.do(key, fun)
+        if shared:
+            self.stats.incr('single_flight_shared')
+            # Hand out copies, so that callers can't see each other's changes
+            data = copy.deepcopy(data)
+        return data
 
     def codeunit(self, service_name, function, func_args=None):
         """Get a Codeunit's results
@@ -200,14 +826,20 @@ class NAV:
                 Add these kw args to the codeunit function call
 
         """
-        srvc = self.make_service(
-            endpoint_type=CODEUNIT,
-            service_name=service_name,
-        )
-        func = getattr(srvc, function)
-        data = func(**func_args)
+        def run():
+            srvc = self.make_service(
+                endpoint_type=CODEUNIT,
+                service_name=service_name,
+            )
+            return self._call(srvc, function, **func_args)
 
-        return to_builtins(data, default=[])
+        return self._run_single_flight(
+            CODEUNIT,
+            service_name,
+            function,
+            func_args,
+            run,
+        )
 
     def page(
         self,
@@ -224,24 +856,83 @@ class NAV:
             service_name:
                 The name of the WS Page
             function:
-                The function to use. Currently supported functions are ReadMultiple and CreateMultiple
+                The function to use. Currently supported functions are ReadMultiple, CreateMultiple, UpdateMultiple, Delete, Read, ReadByRecId and GetRecIdFromKey
             num_results:
                 Maximum amount of results to return for ReadMultiple. Defaults to no limit
             filters:
                 Apply filters to a ReadMultiple result
             entries:
-                Entries to pass to CreateMultiple
+                Entries to pass to CreateMultiple or UpdateMultiple
             additional_data:
-                Any additional data to pass along to the WS call
+                Any additional data to pass along to the WS call. This holds
+                the arguments of Delete, Read, ReadByRecId and GetRecIdFromKey
 
         """
         self.validate_supported_page_function(function)
+        return self._run_single_flight(
+            PAGE,
+            service_name,
+            function,
+            (num_results, filters, entries, additional_data),
+            lambda: self._page(
+                service_name,
+                function,
+                num_results,
+                filters,
+                entries,
+                additional_data,
+            ),
+        )
 
+    def _page(
+        self,
+        service_name,
+        function,
+        num_results,
+        filters,
+        entries,
+        additional_data,
+    ):
         srvc = self.make_service(
             endpoint_type=PAGE,
             service_name=service_name,
         )
+        data = self._call(
+            srvc,
+            function,
+            **self._make_page_call_kw(
+                service_name,
+                function,
+                num_results,
+                filters,
+                entries,
+                additional_data,
+            ),
+        )
+        self._track_writes(service_name, function, entries, additional_data, data)
+        return data
+
+    def _track_writes(self, service_name, function, entries, additional_data, data):
+        """Keep the identity map in line with entries written by this client"""
+        if function == UpdateMultiple:
+            self._forget_records(
+                service_name,
+                [entry.get('Key') for entry in entries],
+            )
+        elif function == Delete:
+            self._forget_records(service_name, [additional_data.get('Key')])
+        if function in (CreateMultiple, UpdateMultiple):
+            self._remember_records(service_name, data)
 
+    def _make_page_call_kw(
+        self,
+        service_name,
+        function,
+        num_results,
+        filters,
+        entries,
+        additional_data,
+    ):
         if not filters:
             # NOTE: Workaround because the definition files for NAV 2009 R2 pages
             # requires the filter element to be defined (minOccurs=1), causing
@@ -254,27 +945,175 @@ class NAV:
         call_kw = dict(additional_data or {})
 
         if function == ReadMultiple:
-            data = srvc.ReadMultiple(
+            call_kw.update(
                 filter=self._make_page_filters(filters),
                 setSize=num_results,
-                **call_kw,
             )
-        elif function == CreateMultiple:
+        elif function in (CreateMultiple, UpdateMultiple):
             if not entries:
                 raise ValueError(
-                    "Can't run Page CreateMultiple without passing in "
-                    "any `entries`"
+                    "Can't run Page {} without passing in "
+                    "any `entries`".format(function)
                 )
             call_kw.update({
                 '{}_List'.format(service_name): [
                     {service_name: [entry for entry in entries]}
                 ],
             })
-            data = srvc.CreateMultiple(**call_kw)
-        else:
+        elif function not in (Delete, Read, ReadByRecId, GetRecIdFromKey):
             raise NotImplementedError
 
-        return to_builtins(data, default=[])
+        return call_kw
+
+    def prepare(
+        self,
+        service_name,
+        function,
+        num_results=0,
+        filters=None,
+        entries=None,
+        additional_data=None
+    ):
+        """Serialize a page call once, to run it any amount of times
+
+        The returned `PreparedCall` sends the same request bytes on every
+        `execute`, skipping the building and serialization of the envelope.
+        The arguments are the same as for `page`.
+        """
+        self.validate_supported_page_function(function)
+        srvc = self.make_service(
+            endpoint_type=PAGE,
+            service_name=service_name,
+        )
+        kw = self._make_page_call_kw(
+            service_name,
+            function,
+            num_results,
+            filters,
+            entries,
+            additional_data,
+        )
+        return PreparedCall(
+            self,
+            srvc,
+            service_name,
+            function,
+            self._make_envelope(srvc, function, kw),
+            track_writes=functools.partial(
+                self._track_writes,
+                service_name,
+                function,
+                entries,
+                additional_data,
+            ),
+        )
+
+    def prepare_codeunit(self, service_name, function, func_args=None):
+        """Serialize a codeunit call once, to run it any amount of times
+
+        See `prepare`. The arguments are the same as for `codeunit`.
+        """
+        srvc = self.make_service(
+            endpoint_type=CODEUNIT,
+            service_name=service_name,
+        )
+        return PreparedCall(
+            self,
+            srvc,
+            service_name,
+            function,
+            self._make_envelope(srvc, function, func_args or {}),
+        )
+
+    def _remember_records(self, service_name, records):
+        for record in records or ():
+            if record and record.get('Key'):
+                self._records.put(
+                    (self._cache_scope, service_name, record['Key']),
+                    record,
+                )
+
+    def _forget_records(self, service_name, keys):
+        for key in keys:
+            self._records.discard((self._cache_scope, service_name, key))
+
+    def read(self, service_name, key_fields):
+        """Get a single entry from a NAV page by its primary key fields
+
+        Entries are kept in memory for a while, see `identity_map_size` and
+        `identity_map_ttl`.
+
+        Args:
+            service_name:
+                The name of the WS Page
+            key_fields:
+                Values of the primary key fields, e.g. `{'No': '10000'}`
+
+        Returns:
+            The entry, or None if there is none with the given key
+
+        """
+        alias = (self._cache_scope, service_name, freeze(key_fields))
+        key = self._record_keys.get(alias)
+        if key is not None:
+            record = self._records.get((self._cache_scope, service_name, key))
+            if record is not None:
+                self.stats.incr('identity_map_hits')
+                return record
+        self.stats.incr('identity_map_misses')
+
+        record = self.page(
+            service_name=service_name,
+            function=Read,
+            additional_data=key_fields,
+        )
+        if not record:
+            return None
+        self._remember_records(service_name, [record])
+        self._record_keys.put(alias, record['Key'])
+        return record
+
+    def read_by_key(self, service_name, key):
+        """Get a single entry from a NAV page by its `Key`
+
+        Entries are kept in memory for a while, see `identity_map_size` and
+        `identity_map_ttl`.
+
+        Args:
+            service_name:
+                The name of the WS Page
+            key:
+                The `Key` of the entry, as returned by earlier reads
+
+        Returns:
+            The entry, or None if it was deleted while being read
+
+        Raises:
+            zeep.exceptions.Fault: When there is no entry with the given key,
+                e.g. because it was changed since `key` was read, as NAV
+                rejects unknown keys
+
+        """
+        record = self._records.get((self._cache_scope, service_name, key))
+        if record is not None:
+            self.stats.incr('identity_map_hits')
+            return record
+        self.stats.incr('identity_map_misses')
+
+        rec_id = self.page(
+            service_name=service_name,
+            function=GetRecIdFromKey,
+            additional_data={'Key': key},
+        )
+        record = self.page(
+            service_name=service_name,
+            function=ReadByRecId,
+            additional_data={'recId': rec_id},
+        )
+        if not record:
+            return None
+        self._remember_records(service_name, [record])
+        return record
 
     def read_multiple(
         self,
@@ -304,11 +1143,259 @@ class NAV:
             additional_data=additional_data,
         )
 
+    def iter_read_multiple(
+        self,
+        service_name,
+        filters=None,
+        page_size=DEFAULT_PAGE_SIZE,
+        additional_data=None,
+        prefetch=0,
+    ):
+        """Iterate over all results from a NAV page, fetching them in chunks
+
+        Chunks of `page_size` entries are requested one at a time, continuing
+        after the `Key` of the last entry of the previous chunk.
+
+        Args:
+            service_name:
+                The name of the WS Page
+            filters:
+                Apply filters to the query
+            page_size:
+                Amount of entries to fetch per request. Defaults to 1000
+            additional_data:
+                Any additional data to pass along to the WS call
+            prefetch:
+                Amount of chunks to request and decode in a background thread
+                ahead of the consumer, so that requests overlap with the
+                processing of earlier entries. Defaults to 0, i.e. request
+                each chunk once the previous one is consumed
+
+        Yields:
+            Each entry of the page
+
+        """
+        chunks = self._iter_read_multiple_chunks(
+            service_name,
+            filters,
+            page_size,
+            additional_data,
+        )
+        if prefetch:
+            chunks = prefetch_iter(chunks, prefetch)
+        try:
+            for chunk in chunks:
+                yield from chunk
+        finally:
+            chunks.close()
+
+    def _iter_read_multiple_chunks(
+        self,
+        service_name,
+        filters,
+        page_size,
+        additional_data,
+    ):
+        bookmark_key = None
+        while True:
+            call_kw = dict(additional_data or {})
+            if bookmark_key is not None:
+                call_kw['bookmarkKey'] = bookmark_key
+            chunk = self.read_multiple(
+                service_name=service_name,
+                num_results=page_size,
+                filters=filters,
+                additional_data=call_kw,
+            )
+            yield chunk
+
+            if not page_size or len(chunk) < page_size:
+                return
+            bookmark_key = chunk[-1].get('Key')
+            if bookmark_key is None:
+                raise ValueError(
+                    "Can't continue reading `{}` as its entries have no `Key`"
+                    .format(service_name)
+                )
+
+    def mirror(
+        self,
+        service_name,
+        db_path,
+        index_fields=(),
+        key_fields=None,
+        since_field=None,
+        filters=None,
+        page_size=DEFAULT_PAGE_SIZE,
+    ):
+        """Replicate a NAV page into a local SQLite database
+
+        Loads the page into the database, or refreshes it if it's already
+        there, and returns a `nav.mirror.Mirror` to query it with NAV style
+        filters. See `nav.mirror.Mirror` for details on the arguments.
+
+        Args:
+            service_name:
+                The name of the WS Page
+            db_path:
+                Path of the SQLite database
+            index_fields:
+                Fields to index
+            key_fields:
+                Fields uniquely identifying an entry, required for incremental
+                refreshes
+            since_field:
+                A field holding when an entry was last modified, to only read
+                recently modified entries when refreshing
+            filters:
+                Only replicate the entries matching these filters
+            page_size:
+                Amount of entries to read per request. Defaults to 1000
+
+        """
+        mirror = _mirror.Mirror(
+            self,
+            service_name,
+            db_path,
+            index_fields=index_fields,
+            key_fields=key_fields,
+            since_field=since_field,
+            filters=filters,
+            page_size=page_size,
+        )
+        mirror.refresh()
+        return mirror
+
+    def iter_read_multiple_all_companies(
+        self,
+        service_name,
+        companies,
+        num_results=0,
+        filters=None,
+        additional_data=None
+    ):
+        """Concurrently get multiple results from a NAV page for several companies
+
+        Results are yielded as soon as each company's request completes.
+
+        Args:
+            service_name:
+                The name of the WS Page
+            companies:
+                Names of the companies to query
+            num_results:
+                Maximum amount of results to return per company. Defaults to no limit
+            filters:
+                Apply filters to the query
+            additional_data:
+                Any additional data to pass along to the WS call
+
+        Yields:
+            `(company, results)` tuples in order of completion
+
+        """
+        navs = self.for_companies(companies)
+        yield from self._iter_concurrently(
+            lambda company: navs[company].read_multiple(
+                service_name=service_name,
+                num_results=num_results,
+                filters=filters,
+                additional_data=additional_data,
+            ),
+            navs,
+        )
+
+    def read_multiple_all_companies(
+        self,
+        service_name,
+        companies,
+        num_results=0,
+        filters=None,
+        additional_data=None
+    ):
+        """Concurrently get multiple results from a NAV page for several companies
+
+        Args:
+            service_name:
+                The name of the WS Page
+            companies:
+                Names of the companies to query
+            num_results:
+                Maximum amount of results to return per company. Defaults to no limit
+            filters:
+                Apply filters to the query
+            additional_data:
+                Any additional data to pass along to the WS call
+
+        Returns:
+            A dict mapping each company name to its results, in the same
+            order as `companies`
+
+        """
+        results = dict(self.iter_read_multiple_all_companies(
+            service_name=service_name,
+            companies=companies,
+            num_results=num_results,
+            filters=filters,
+            additional_data=additional_data,
+        ))
+        return {company: results[company] for company in companies}
+
+    def get_many(
+        self,
+        service_name,
+        field,
+        keys,
+        filters=None,
+        max_criteria_length=DEFAULT_MAX_CRITERIA_LENGTH,
+    ):
+        """Look up many NAV page entries by the value of a field
+
+        Keys are packed into `|` separated filter criteria, e.g.
+        `1001|1002|1003`, and the resulting requests are run concurrently.
+
+        Args:
+            service_name:
+                The name of the WS Page
+            field:
+                The field to look up the keys in, e.g. `No`
+            keys:
+                The values to look up. Compared to the field values as strings
+            filters:
+                Additional filters to apply to the query
+            max_criteria_length:
+                Maximum length of the criteria for each request. Defaults to 1024
+
+        Returns:
+            A `GetManyResult` with `found`, a dict mapping each found key to its
+            entry in the requested order, and `missing`, a list of the keys
+            that NAV returned no entry for
+
+        """
+        keys = list(dict.fromkeys(str(key) for key in keys))
+        entries = {}
+        results = self._iter_concurrently(
+            lambda criteria: self.read_multiple(
+                service_name,
+                filters=dict(filters or {}, **{field: criteria}),
+            ),
+            chunk_filter_criteria(keys, max_criteria_length),
+        )
+        for _, data in results:
+            for entry in data:
+                entries.setdefault(str(entry.get(field)), entry)
+
+        return GetManyResult(
+            found={key: entries[key] for key in keys if key in entries},
+            missing=[key for key in keys if key not in entries],
+        )
+
     def create_multiple(
         self,
         service_name,
         entries=None,
-        additional_data=None
+        additional_data=None,
+        on_error=ON_ERROR_RAISE,
     ):
         """Create multiple NAV Page entries
 
@@ -319,13 +1406,208 @@ class NAV:
                 Entries to pass to CreateMultiple
             additional_data
                 Any additional data to pass along to the WS call
+            on_error
+                What to do when NAV rejects the call. "raise" (the default)
+                raises the error. "bisect" repeatedly splits the rejected
+                entries in halves and retries them, to create all valid entries
+                in as few requests as possible. Only SOAP faults are bisected,
+                other errors, e.g. failed authentication, are raised
+
+        Returns:
+            The created entries, or a `CreateMultipleReport` when `on_error` is
+            "bisect". The report holds the `created` entries and a list of
+            `FailedEntry` tuples of `index`, `entry` and `error` (the fault
+            text that NAV responded with) for each entry that NAV rejected
 
         """
-        return self.page(
-            service_name=service_name,
-            function=CreateMultiple,
-            entries=entries,
-            additional_data=additional_data,
+        if on_error == ON_ERROR_RAISE:
+            return self.page(
+                service_name=service_name,
+                function=CreateMultiple,
+                entries=entries,
+                additional_data=additional_data,
+            )
+        _check_on_error(on_error, (ON_ERROR_RAISE, ON_ERROR_BISECT))
+
+        report = CreateMultipleReport(created=[], failed=[])
+        self._create_multiple_bisect(
+            service_name,
+            list(enumerate(entries or [])),
+            additional_data,
+            report,
+        )
+        return report
+
+    def update_multiple(
+        self,
+        service_name,
+        entries,
+        batch_size=DEFAULT_UPDATE_BATCH_SIZE,
+        additional_data=None,
+        on_error=ON_ERROR_RAISE,
+    ):
+        """Update NAV Page entries in concurrent batches
+
+        NAV only accepts an update when the `Key` of the entry is the one it
+        currently has, so pass the entries with the `Key` they were read
+        with, and use the `Key` of the returned entries for later updates.
+
+        Args:
+            service_name
+                The name of the WS Page
+            entries
+                The fields to change per entry, along with its `Key`
+            batch_size
+                Amount of entries to update per UpdateMultiple call. Defaults
+                to 100
+            additional_data
+                Any additional data to pass along to the WS calls
+            on_error
+                What to do when a batch fails. "raise" (the default) raises
+                the error, without the results of the batches that NAV has
+                already committed. "report" runs all batches and reports the
+                failed ones
+
+        Returns:
+            The updated entries, in the order of `entries`, or an
+            `UpdateMultipleReport` when `on_error` is "report". The report holds
+            the `updated` entries, with `None` for the entries of failed
+            batches, and a `FailedEntry` for each of those entries
+
+        """
+        _check_on_error(on_error, (ON_ERROR_RAISE, ON_ERROR_REPORT))
+        entries = list(entries)
+        for index, entry in enumerate(entries):
+            if not entry.get('Key'):
+                raise ValueError(
+                    "Can't update entry #{} without its `Key`".format(index)
+                )
+        batches = [
+            (start, entries[start:start + batch_size])
+            for start in range(0, len(entries), batch_size)
+        ]
+        report = UpdateMultipleReport(updated=[None] * len(entries), failed=[])
+        for (start, batch), (result, error) in self._iter_batches(
+            lambda item: self.page(
+                service_name=service_name,
+                function=UpdateMultiple,
+                entries=item[1],
+                additional_data=additional_data,
+            ),
+            batches,
+            on_error,
+        ):
+            if error is None:
+                report.updated[start:start + len(batch)] = result
+            else:
+                report.failed.extend(
+                    FailedEntry(index=start + i, entry=entry, error=error)
+                    for i, entry in enumerate(batch)
+                )
+        if on_error == ON_ERROR_RAISE:
+            return report.updated
+        report.failed.sort(key=lambda failed: failed.index)
+        return report
+
+    def delete(self, service_name, keys, on_error=ON_ERROR_RAISE):
+        """Concurrently delete NAV Page entries
+
+        Args:
+            service_name
+                The name of the WS Page
+            keys
+                The `Key` of each entry to delete, or the entries themselves
+            on_error
+                What to do when a call fails. "raise" (the default) raises the
+                error, without the results of the other calls. "report" runs
+                all calls and reports the failed ones
+
+        Returns:
+            A list of whether each entry was deleted, in the order of `keys`,
+            or a `DeleteReport` when `on_error` is "report". The report holds
+            the `deleted` list, with `None` for the failed calls, and a
+            `FailedEntry` with the `Key` as `entry` for each of those
+
+        """
+        _check_on_error(on_error, (ON_ERROR_RAISE, ON_ERROR_REPORT))
+        keys = [k['Key'] if isinstance(k, dict) else k for k in keys]
+        report = DeleteReport(deleted=[None] * len(keys), failed=[])
+        for (index, key), (result, error) in self._iter_batches(
+            lambda item: self.page(
+                service_name=service_name,
+                function=Delete,
+                additional_data={'Key': item[1]},
+            ),
+            list(enumerate(keys)),
+            on_error,
+        ):
+            if error is None:
+                report.deleted[index] = result
+            else:
+                report.failed.append(FailedEntry(index=index, entry=key, error=error))
+        if on_error == ON_ERROR_RAISE:
+            return report.deleted
+        report.failed.sort(key=lambda failed: failed.index)
+        return report
+
+    def _iter_batches(self, fun, items, on_error):
+        """Run `fun` for each item like `_iter_concurrently`
+
+        Yields `(item, (result, error))` tuples. With `on_error` "report",
+        failed calls give the text of their error instead of raising it.
+        """
+        def call(item):
+            try:
+                return fun(item), None
+            except (zeep.exceptions.Fault, requests.exceptions.RequestException) as exc:
+                if on_error == ON_ERROR_RAISE:
+                    raise
+                return None, exceptions.fault_text(exc)
+
+        return self._iter_concurrently(call, items)
+
+    def _create_multiple_bisect(
+        self,
+        service_name,
+        indexed_entries,
+        additional_data,
+        report,
+    ):
+        # NOTE: Relies on NAV running CreateMultiple in a single transaction,
+        # i.e. nothing is created when the call fails.
+        try:
+            created = self.page(
+                service_name=service_name,
+                function=CreateMultiple,
+                entries=[entry for _, entry in indexed_entries],
+                additional_data=additional_data,
+            )
+        except zeep.exceptions.Fault as exc:
+            if len(indexed_entries) == 1:
+                index, entry = indexed_entries[0]
+                report.failed.append(FailedEntry(
+                    index=index,
+                    entry=entry,
+                    error=exceptions.fault_text(exc),
+                ))
+                return
+            middle = len(indexed_entries) // 2
+            for half in (indexed_entries[:middle], indexed_entries[middle:]):
+                self._create_multiple_bisect(
+                    service_name,
+                    half,
+                    additional_data,
+                    report,
+                )
+        else:
+            report.created.extend(created)
+
+
+def _check_on_error(on_error, choices):
+    if on_error not in choices:
+        raise ValueError(
+            '`{}` is not a valid on_error value, must be one of {}'
+            .format(on_error, choices)
         )
 
 
@@ -1,14 +1,22 @@
 import getpass
 import functools
+import inspect
 import logging
 import logging.config
+import os
+import sys
+import time
 
 import IPython
+import IPython.terminal.embed
 import argh
 import lxml
 import traitlets
 
 import nav
+import nav.batch
+import nav.profiling
+import nav.server
 import nav.utils
 from nav.wrappers import json
 
@@ -22,15 +30,62 @@ def _set_log_level(log_level):
 
 
 def _get_username(config_getter, username):
-    return username or config_getter('username', None) or input('Username: ')
+    with nav.profiling.phase(nav.profiling.CONFIG):
+        return username or config_getter('username', None) or input('Username: ')
 
 
 def _get_password(config_getter, password):
-    return (
-        password or
-        config_getter('password', None) or
-        getpass.getpass('Password: ')
-    )
+    with nav.profiling.phase(nav.profiling.CONFIG):
+        return (
+            password or
+            config_getter('password', None) or
+            getpass.getpass('Password: ')
+        )
+
+
+def _check_via_daemon(**options):
+    """Refuse connection options that a daemon call would ignore"""
+    given = sorted(name for name, value in options.items() if value)
+    if given:
+        raise argh.CommandError(
+            '--via-daemon uses the settings of the daemon, so {} can\'t be '
+            'used with it'.format(', '.join(
+                '--' + name.replace('_', '-') for name in given
+            ))
+        )
+
+
+def _profiled(func):
+    """Add a `--profile` flag to a command, which reports where time went"""
+    @functools.wraps(func)
+    def wrapper(*args, profile=False, **kw):
+        if not profile:
+            return func(*args, **kw)
+        # NOTE: The CPU time of the process so far is what starting the
+        # interpreter and importing nav and its dependencies took.
+        with nav.profiling.Profile(
+            initial_phases={nav.profiling.IMPORT: time.process_time()},
+        ) as prof:
+            output = func(*args, **kw)
+            with nav.profiling.phase(nav.profiling.OUTPUT):
+                if output is not None:
+                    print(output)
+        print(prof.report(), file=sys.stderr)
+
+    signature = inspect.signature(func)
+    wrapper.__signature__ = signature.replace(parameters=[
+        *signature.parameters.values(),
+        inspect.Parameter(
+            'profile',
+            inspect.Parameter.POSITIONAL_OR_KEYWORD,
+            default=False,
+        ),
+    ])
+    return argh.arg(
+        '--profile',
+        help='Report time spent per phase, the top functions and peak memory '
+             'use on stderr. Slows down the command',
+    )(wrapper)
 
 
 @argh.arg('endpoint-type', help='Web services endpoint type')
@@ -41,6 +96,7 @@ def _get_password(config_getter, password):
 @argh.arg('-l', '--log-level', help='The log level to use')
 @argh.arg('-i', '--insecure', help="Skip certificate validation over HTTPS connections")
 @argh.arg('-c', '--config-section', help='The config section to get settings from.')
+@_profiled
 def meta(
     endpoint_type,
     service_name,
@@ -96,6 +152,7 @@ def interact(
 Available vars:
     {additional_arg}
     `create_service` - Create a WS service to make calls to
+    `%navprofile <statement>` - Report where the time of a statement went
 
 Example usage:
     service = create_service('Page', 'ItemList')
@@ -133,16 +190,28 @@ Example usage:
             additional_arg_example='',
         )
 
-    IPython.embed(
+    # NOTE: Same as `IPython.embed`, except that the shell is at hand to
+    # register the `%navprofile` magic with. Like `IPython.embed(using=False)`
+    # it leaves the colors alone, to fix input not being colored.
+    # See: https://github.com/ipython/ipython/issues/11523
+    shell = IPython.terminal.embed.InteractiveShellEmbed.instance(
         user_ns=user_ns,
         banner1=banner1,
         config=traitlets.config.Config(colors='LightBG'),
-        # To fix no colored input we pass in `using=False`
-        # See: https://github.com/ipython/ipython/issues/11523
-        # TODO: Remove once this is fixed upstream
-        using=False,
     )
 
+    def navprofile(line):
+        """Run a statement and report where its time went"""
+        with nav.profiling.Profile() as prof:
+            shell.ex(line)
+        print(prof.report())
+
+    shell.register_magic_function(navprofile, 'line', 'navprofile')
+    try:
+        shell()
+    finally:
+        IPython.terminal.embed.InteractiveShellEmbed.clear_instance()
+
 
 @argh.arg('service-name', help='Name of the code unit')
 @argh.arg('func', help='Name of the function to run')
@@ -153,6 +222,8 @@ Example usage:
 @argh.arg('-i', '--insecure', help="Skip certificate validation over HTTPS connections")
 @argh.arg('-l', '--log-level', help='The log level to use')
 @argh.arg('-c', '--config-section', help='The config section to get settings from.')
+@argh.arg('-v', '--via-daemon', help='Forward the call to a running `nav serve` daemon')
+@_profiled
 def codeunit(
     service_name,
     func,
@@ -162,10 +233,27 @@ def codeunit(
     func_args=(),
     insecure=False,
     log_level=None,
-    config_section='nav'
+    config_section='nav',
+    via_daemon=False,
 ):
     """Get a Codeunit's results"""
     _set_log_level(log_level)
+    if via_daemon:
+        _check_via_daemon(
+            base_url=base_url,
+            username=username,
+            password=password,
+            insecure=insecure,
+        )
+        data = nav.server.forward(
+            'codeunit',
+            config_section=config_section,
+            service_name=service_name,
+            function=func,
+            func_args=dict(f.split('=') for f in func_args),
+        )
+        return json.dumps(data, indent=2)
+
     c = functools.partial(nav.config.get, config_section)
     username = _get_username(c, username)
     password = _get_password(c, password)
@@ -195,6 +283,8 @@ def codeunit(
 @argh.arg('-l', '--log-level', help='The log level to use')
 @argh.arg('-i', '--insecure', help="Skip certificate validation over HTTPS connections")
 @argh.arg('-c', '--config-section', help='The config section to get settings from.')
+@argh.arg('-v', '--via-daemon', help='Forward the call to a running `nav serve` daemon')
+@_profiled
 def page(
     service_name,
     func,
@@ -207,10 +297,33 @@ def page(
     num_results=0,
     log_level=None,
     insecure=False,
-    config_section='nav'
+    config_section='nav',
+    via_daemon=False,
 ):
     """Get a Page's results"""
     _set_log_level(log_level)
+    if via_daemon:
+        _check_via_daemon(
+            base_url=base_url,
+            username=username,
+            password=password,
+            insecure=insecure,
+        )
+        data = nav.server.forward(
+            'page',
+            config_section=config_section,
+            service_name=service_name,
+            function=func,
+            filters=dict(f.split('=') for f in filters),
+            entries=[
+                dict(field.split('=') for field in entry.split(','))
+                for entry in entries
+            ],
+            additional_data=dict(ad.split('=') for ad in additional_data),
+            num_results=num_results,
+        )
+        return json.dumps(data, indent=2)
+
     c = functools.partial(nav.config.get, config_section)
     username = _get_username(c, username)
     password = _get_password(c, password)
@@ -239,11 +352,157 @@ def page(
     return json.dumps(data, indent=2)
 
 
+@argh.arg('service-name', help='Name of the WS page')
+@argh.arg('db-path', help='Path of the SQLite database to replicate the page to')
+@argh.arg('-x', '--index-fields', nargs='+', type=str, help='Fields to index')
+@argh.arg('-k', '--key-fields', nargs='+', type=str, help='Fields uniquely identifying an entry, required for incremental refreshes')
+@argh.arg('-s', '--since-field', help='Field holding the last modification date of an entry, for incremental refreshes')
+@argh.arg('-f', '--filters', nargs='+', type=str, help='Only replicate entries matching these filters')
+@argh.arg('--full', help='Always reload the whole page')
+@argh.arg('-b', '--base-url', help='The base URL for the endpoint.')
+@argh.arg('-u', '--username', help='Web services username')
+@argh.arg('-p', '--password', help='Web services password')
+@argh.arg('-l', '--log-level', help='The log level to use')
+@argh.arg('-i', '--insecure', help="Skip certificate validation over HTTPS connections")
+@argh.arg('-c', '--config-section', help='The config section to get settings from.')
+@_profiled
+def mirror(
+    service_name,
+    db_path,
+    index_fields=(),
+    key_fields=(),
+    since_field=None,
+    filters=(),
+    full=False,
+    base_url=None,
+    username=None,
+    password=None,
+    log_level=None,
+    insecure=False,
+    config_section='nav',
+):
+    """Replicate a Page into a local SQLite database, or refresh the replica"""
+    _set_log_level(log_level)
+    c = functools.partial(nav.config.get, config_section)
+    nv = nav.NAV(
+        base_url=c('base_url', base_url),
+        username=_get_username(c, username),
+        password=_get_password(c, password),
+        verify_certificate=not insecure,
+    )
+    replica = nav.mirror.Mirror(
+        nv,
+        service_name,
+        db_path,
+        index_fields=index_fields,
+        key_fields=key_fields,
+        since_field=since_field,
+        filters=dict(f.split('=') for f in filters),
+    )
+    try:
+        return json.dumps(replica.refresh(full=full), indent=2)
+    finally:
+        replica.close()
+
+
+@argh.arg('--host', help='The interface to listen on')
+@argh.arg('--port', help='The port to listen on')
+@argh.arg('-s', '--socket', help='Listen on this Unix socket instead, only accessible to the current user')
+@argh.arg('-u', '--username', help='Web services username')
+@argh.arg('-p', '--password', help='Web services password')
+@argh.arg('-l', '--log-level', help='The log level to use')
+@argh.arg('-i', '--insecure', help="Skip certificate validation over HTTPS connections")
+@argh.arg('-c', '--config-section', nargs='+', type=str, help='The config sections to serve.')
+def serve(
+    host=nav.server.DEFAULT_HOST,
+    port=nav.server.DEFAULT_PORT,
+    username=None,
+    password=None,
+    log_level=None,
+    insecure=False,
+    config_section=('nav',),
+    socket=None,
+):
+    """Run a local daemon keeping warm NAV clients, see `--via-daemon`"""
+    _set_log_level(log_level)
+    navs = {}
+    for section in config_section:
+        c = functools.partial(nav.config.get, section)
+        navs[section] = nav.NAV(
+            base_url=c('base_url'),
+            username=_get_username(c, username),
+            password=_get_password(c, password),
+            verify_certificate=not insecure,
+        )
+
+    if socket:
+        server = nav.server.UnixGatewayServer(socket, navs)
+        print('Serving {} on unix:{}'.format(', '.join(navs), socket))
+    else:
+        server = nav.server.GatewayServer((host, int(port)), navs)
+        print('Serving {} on http://{}:{}'.format(
+            ', '.join(navs),
+            *server.server_address[:2],
+        ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@argh.arg('jobs-path', help='Path of the JSON job file, see `nav.batch`')
+@argh.arg('-o', '--output-dir', help='Directory to write job results to')
+@argh.arg('-w', '--workers', help='Maximum amount of jobs to run at the same time')
+@argh.arg('-b', '--base-url', help='The base URL for the endpoint.')
+@argh.arg('-u', '--username', help='Web services username')
+@argh.arg('-p', '--password', help='Web services password')
+@argh.arg('-l', '--log-level', help='The log level to use')
+@argh.arg('-i', '--insecure', help="Skip certificate validation over HTTPS connections")
+@argh.arg('-c', '--config-section', help='The config section to get settings from.')
+@_profiled
+def batch(
+    jobs_path,
+    output_dir='.',
+    workers=nav.constants.DEFAULT_MAX_WORKERS,
+    base_url=None,
+    username=None,
+    password=None,
+    log_level=None,
+    insecure=False,
+    config_section='nav',
+):
+    """Run the page and codeunit calls of a job file on a shared client"""
+    _set_log_level(log_level)
+    jobs = nav.batch.load_jobs(jobs_path)
+    c = functools.partial(nav.config.get, config_section)
+    nv = nav.NAV(
+        base_url=c('base_url', base_url),
+        username=_get_username(c, username),
+        password=_get_password(c, password),
+        verify_certificate=not insecure,
+        max_workers=int(workers),
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    try:
+        results = nav.batch.run(nv, jobs, output_dir, max_workers=int(workers))
+    finally:
+        nv.close()
+    print(nav.batch.format_summary(results, time.perf_counter() - started))
+    if any(r.status != nav.batch.OK for r in results):
+        raise argh.CommandError('Not all jobs succeeded')
+
+
 command_parser = argh.ArghParser()
 command_parser.add_commands([
     interact,
     meta,
     codeunit,
     page,
+    mirror,
+    serve,
+    batch,
 ])
 main = command_parser.dispatch
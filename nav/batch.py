@@ -0,0 +1,290 @@
+"""
+Run a declarative file of page and codeunit calls on a single `NAV` client,
+rather than one process per call.
+
+A job file is a JSON list of jobs, e.g::
+
+    [
+        {"id": "customers", "type": "Page", "service": "CustomerList",
+         "function": "ReadMultiple", "filters": {"Blocked": "false"}},
+        {"id": "create", "type": "Page", "service": "CustomerList",
+         "function": "CreateMultiple", "entries": [{"Name": "New"}],
+         "depends_on": ["customers"]},
+        {"id": "hello", "type": "Codeunit", "service": "IntegrationEntry",
+         "function": "HelloWorld", "args": {"iName": "Jacob"}}
+    ]
+
+Jobs run concurrently once all jobs listed in their `depends_on` have
+succeeded, and are skipped if any of those failed. The result of each job is
+written to `<output_dir>/<id>.json`, or to the path in its `output` key.
+`ReadMultiple` jobs without `num_results` are read in chunks of `page_size`
+and streamed to their file entry by entry.
+"""
+import collections
+import concurrent.futures
+import os
+import time
+
+from . import exceptions
+from .constants import (
+    CODEUNIT,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_PAGE_SIZE,
+    PAGE,
+    ReadMultiple,
+)
+from .wrappers import json
+
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+_JOB_KEYS = frozenset([
+    'id',
+    'type',
+    'service',
+    'function',
+    'filters',
+    'entries',
+    'additional_data',
+    'num_results',
+    'page_size',
+    'args',
+    'depends_on',
+    'output',
+])
+
+Job = collections.namedtuple('Job', [
+    'id',
+    'type',
+    'service',
+    'function',
+    'filters',
+    'entries',
+    'additional_data',
+    'num_results',
+    'page_size',
+    'args',
+    'depends_on',
+    'output',
+])
+JobResult = collections.namedtuple(
+    'JobResult',
+    ['id', 'status', 'entries', 'seconds', 'error'],
+)
+
+
+def parse_jobs(data):
+    """Validate the decoded contents of a job file and turn them into `Job`s
+
+    Raises:
+        nav.exceptions.InvalidBatchJobs: When a job is malformed, ids are
+            duplicated, or dependencies are unknown or circular
+    """
+    if not isinstance(data, list):
+        raise exceptions.InvalidBatchJobs('Expected a list of jobs')
+
+    jobs = []
+    for i, spec in enumerate(data):
+        if not isinstance(spec, dict):
+            raise exceptions.InvalidBatchJobs('Job #{} is not an object'.format(i))
+        unknown = set(spec) - _JOB_KEYS
+        if unknown:
+            raise exceptions.InvalidBatchJobs(
+                'Job #{} has unknown keys {}'.format(i, sorted(unknown))
+            )
+        missing = [k for k in ('id', 'type', 'service', 'function') if k not in spec]
+        if missing:
+            raise exceptions.InvalidBatchJobs(
+                'Job #{} lacks {}'.format(i, missing)
+            )
+        if spec['type'] not in (PAGE, CODEUNIT):
+            raise exceptions.InvalidBatchJobs(
+                'Job `{}` has invalid type `{}`, must be one of {}'
+                .format(spec['id'], spec['type'], (PAGE, CODEUNIT))
+            )
+        jobs.append(Job(
+            id=str(spec['id']),
+            type=spec['type'],
+            service=spec['service'],
+            function=spec['function'],
+            filters=spec.get('filters'),
+            entries=spec.get('entries'),
+            additional_data=spec.get('additional_data'),
+            num_results=spec.get('num_results', 0),
+            page_size=spec.get('page_size', DEFAULT_PAGE_SIZE),
+            args=spec.get('args'),
+            depends_on=tuple(str(d) for d in spec.get('depends_on', ())),
+            output=spec.get('output'),
+        ))
+
+    by_id = {}
+    for job in jobs:
+        if job.id in by_id:
+            raise exceptions.InvalidBatchJobs('Duplicate job id `{}`'.format(job.id))
+        by_id[job.id] = job
+    for job in jobs:
+        for dependency in job.depends_on:
+            if dependency not in by_id:
+                raise exceptions.InvalidBatchJobs(
+                    'Job `{}` depends on unknown job `{}`'
+                    .format(job.id, dependency)
+                )
+
+    # Depth first search for dependency cycles
+    visiting, visited = set(), set()
+
+    def visit(job_id):
+        if job_id in visited:
+            return
+        if job_id in visiting:
+            raise exceptions.InvalidBatchJobs(
+                'Circular dependency on job `{}`'.format(job_id)
+            )
+        visiting.add(job_id)
+        for dependency in by_id[job_id].depends_on:
+            visit(dependency)
+        visiting.discard(job_id)
+        visited.add(job_id)
+
+    for job in jobs:
+        visit(job.id)
+    return jobs
+
+
+def load_jobs(path):
+    with open(path) as f:
+        return parse_jobs(json.load(f))
+
+
+def _output_path(job, output_dir):
+    return job.output or os.path.join(output_dir, '{}.json'.format(job.id))
+
+
+def _results(nv, job):
+    if job.type == CODEUNIT:
+        return nv.codeunit(job.service, job.function, job.args or {})
+    elif job.function == ReadMultiple and not job.num_results:
+        return nv.iter_read_multiple(
+            job.service,
+            filters=job.filters,
+            page_size=job.page_size,
+            additional_data=job.additional_data,
+        )
+    return nv.page(
+        job.service,
+        job.function,
+        num_results=job.num_results,
+        filters=job.filters,
+        entries=job.entries,
+        additional_data=job.additional_data,
+    )
+
+
+def run_job(nv, job, output_dir='.'):
+    """Run a single job and write its result to its output file
+
+    Errors are not raised, they are reported in the returned `JobResult`.
+    """
+    started = time.perf_counter()
+    count = 0
+    try:
+        data = _results(nv, job)
+        with open(_output_path(job, output_dir), 'w') as f:
+            if isinstance(data, (dict, str, int, float, bool, type(None))):
+                json.dump(data, f, indent=2)
+                count = 1 if data is not None else 0
+            else:
+                f.write('[')
+                for count, entry in enumerate(data, 1):
+                    f.write((',\n' if count > 1 else '\n') + json.dumps(entry))
+                f.write('\n]\n' if count else ']\n')
+    except Exception as exc:
+        return JobResult(
+            job.id,
+            FAILED,
+            count,
+            time.perf_counter() - started,
+            exceptions.fault_text(exc),
+        )
+    return JobResult(job.id, OK, count, time.perf_counter() - started, None)
+
+
+def run(nv, jobs, output_dir='.', max_workers=DEFAULT_MAX_WORKERS):
+    """Run jobs concurrently on a shared `NAV` client, respecting dependencies
+
+    Args:
+        nv:
+            The `NAV` client to make all calls with
+        jobs:
+            `Job`s, as returned by `parse_jobs` or `load_jobs`
+        output_dir:
+            Directory to write job results to
+        max_workers:
+            Maximum amount of jobs to run at the same time
+
+    Returns:
+        A `JobResult` per job, in the order of `jobs`
+    """
+    pending = list(jobs)
+    results = {}
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for job in list(pending):
+                    failed = [
+                        d for d in job.depends_on
+                        if d in results and results[d].status != OK
+                    ]
+                    if failed:
+                        results[job.id] = JobResult(
+                            job.id,
+                            SKIPPED,
+                            0,
+                            0,
+                            'Dependencies failed: {}'.format(', '.join(failed)),
+                        )
+                    elif all(d in results for d in job.depends_on):
+                        future = executor.submit(run_job, nv, job, output_dir)
+                        running[future] = job
+                    else:
+                        continue
+                    pending.remove(job)
+                    progress = True
+
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                result = future.result()
+                results[result.id] = result
+                del running[future]
+    return [results[job.id] for job in jobs]
+
+
+def format_summary(results, seconds):
+    """Format a table of job statuses and timings"""
+    width = max([len('job')] + [len(r.id) for r in results])
+    lines = ['{:<{w}}  {:<7}  {:>8}  {:>9}'.format(
+        'job', 'status', 'entries', 'seconds', w=width,
+    )]
+    for r in results:
+        line = '{:<{w}}  {:<7}  {:>8}  {:>9.3f}'.format(
+            r.id, r.status, r.entries, r.seconds, w=width,
+        )
+        if r.error:
+            line += '  ' + r.error
+        lines.append(line)
+    lines.append('{} jobs, {} failed, {} skipped in {:.3f}s'.format(
+        len(results),
+        sum(r.status == FAILED for r in results),
+        sum(r.status == SKIPPED for r in results),
+        seconds,
+    ))
+    return '\n'.join(lines)
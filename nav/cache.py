@@ -0,0 +1,61 @@
+import collections
+import copy
+import threading
+import time
+
+
+class IdentityMap:
+    """Thread-safe, size bounded and expiring map of page records
+
+    The least recently used entries are evicted once more than `max_size`
+    are held, and entries are dropped on access once `ttl` seconds old.
+    Values are copied on the way in and out, so that callers can't change
+    what is held.
+
+    Args:
+        max_size:
+            Maximum amount of entries to hold. 0 disables the map
+        ttl:
+            Seconds an entry is served for. None means no expiry
+    """
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                stored_at, value = self._entries[key]
+            except KeyError:
+                return default
+            if self.ttl is not None and self._clock() - stored_at >= self.ttl:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        if not self.max_size:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (self._clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
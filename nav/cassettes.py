@@ -0,0 +1,217 @@
+"""
+Record the HTTP traffic of a NAV client to a cassette file, and replay it
+later without a NAV server, e.g. to profile or regression test performance.
+
+Cassettes are gzip compressed JSON lines files, one line per request and
+response. Before being written, interactions are scrubbed of credentials and
+of the server address, which is replaced by `ORIGIN_PLACEHOLDER` both in URLs
+and in bodies (e.g. the service addresses in WSDL documents).
+"""
+import base64
+import collections
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+import urllib.parse
+
+import requests.adapters
+from urllib3.response import HTTPResponse
+
+from . import exceptions
+from .constants import CASSETTE_RECORD
+
+ORIGIN_PLACEHOLDER = 'http://nav.invalid'
+
+SCRUBBED_HEADERS = frozenset(h.lower() for h in (
+    'Authorization',
+    'Cookie',
+    'Proxy-Authorization',
+    'Set-Cookie',
+    'WWW-Authenticate',
+    # Recorded bodies are stored decoded
+    'Content-Encoding',
+    'Content-Length',
+    'Transfer-Encoding',
+))
+
+
+def _origin(url):
+    parts = urllib.parse.urlsplit(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+def _request_body(request):
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return body
+
+
+def _body_hash(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+def _scrub_headers(headers):
+    return {
+        key: value for key, value in headers.items()
+        if key.lower() not in SCRUBBED_HEADERS
+    }
+
+
+class CassetteWriter:
+    """Append interactions to a cassette file
+
+    Each interaction is written as its own gzip member, so that the cassette
+    stays readable even if the process is killed while recording.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, request, response, origin):
+        def scrub(data):
+            return data.replace(origin.encode(), ORIGIN_PLACEHOLDER.encode())
+
+        url = request.url.replace(origin, ORIGIN_PLACEHOLDER, 1)
+        body = _request_body(request)
+        interaction = {
+            'method': request.method,
+            'url': url,
+            'soap_action': request.headers.get('SOAPAction'),
+            'request_sha256': _body_hash(scrub(body)),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': _scrub_headers(response.headers),
+            'body': base64.b64encode(scrub(response.content)).decode('ascii'),
+            'elapsed': response.elapsed.total_seconds(),
+        }
+        line = json.dumps(interaction).encode('utf-8') + b'\n'
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                f.write(gzip.compress(line))
+
+
+def read_cassette(path):
+    """Read the interactions of a cassette file"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that records every interaction to a cassette"""
+
+    def __init__(self, writer, origin, **kw):
+        super().__init__(**kw)
+        self.writer = writer
+        self.origin = origin
+
+    def send(self, request, **kw):
+        response = super().send(request, **kw)
+        # Authentication handshakes are never replayed, so skip them
+        if response.status_code != 401:
+            self.writer.write(request, response, self.origin)
+        return response
+
+
+class ReplayAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that serves responses from a cassette
+
+    Requests are matched on method, URL, SOAP action and request body, and
+    `nav.exceptions.InteractionNotRecorded` is raised when none matches.
+    Repeated identical requests are served the recorded responses in order,
+    with the last one repeating indefinitely.
+
+    Args:
+        interactions:
+            Interactions as returned by `read_cassette`
+        origin:
+            The scheme and host of the NAV server, replacing the placeholder
+            of the recording
+        latency:
+            Multiplier of the recorded response times to wait before
+            responding. Defaults to 0, i.e. respond immediately
+        fallback:
+            When no interaction has the same request body, serve the first one
+            recorded for the method, URL and SOAP action instead of raising.
+            Defaults to False
+    """
+
+    def __init__(self, interactions, origin, latency=0, fallback=False, **kw):
+        super().__init__(**kw)
+        self.origin = origin
+        self.latency = latency
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._exact = collections.defaultdict(collections.deque)
+        self._fallback = {}
+        for interaction in interactions:
+            key = (
+                interaction['method'],
+                interaction['url'],
+                interaction['soap_action'],
+            )
+            self._exact[key + (interaction['request_sha256'],)].append(interaction)
+            self._fallback.setdefault(key, interaction)
+
+    def _find(self, request):
+        url = request.url.replace(self.origin, ORIGIN_PLACEHOLDER, 1)
+        body = _request_body(request).replace(
+            self.origin.encode(),
+            ORIGIN_PLACEHOLDER.encode(),
+        )
+        key = (
+            request.method,
+            url,
+            request.headers.get('SOAPAction'),
+            _body_hash(body),
+        )
+        with self._lock:
+            queue = self._exact.get(key)
+            if queue:
+                return queue.popleft() if len(queue) > 1 else queue[0]
+            if self.fallback and key[:3] in self._fallback:
+                return self._fallback[key[:3]]
+            raise exceptions.InteractionNotRecorded(
+                'No recorded interaction for {} {}'
+                .format(request.method, request.url)
+            )
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        interaction = self._find(request)
+        if self.latency:
+            time.sleep(interaction['elapsed'] * self.latency)
+
+        body = base64.b64decode(interaction['body']).replace(
+            ORIGIN_PLACEHOLDER.encode(),
+            self.origin.encode(),
+        )
+        headers = dict(interaction['headers'], **{'Content-Length': str(len(body))})
+        raw = HTTPResponse(
+            body=io.BytesIO(body),
+            headers=headers,
+            status=interaction['status'],
+            reason=interaction['reason'],
+            preload_content=False,
+            decode_content=False,
+        )
+        return self.build_response(request, raw)
+
+
+def make_adapter(mode, path, base_url, latency=0, fallback=False, **kw):
+    """Create the HTTP adapter for a cassette mode, "record" or "replay" """
+    origin = _origin(base_url)
+    if mode == CASSETTE_RECORD:
+        return RecordingAdapter(CassetteWriter(path), origin, **kw)
+    return ReplayAdapter(
+        read_cassette(path),
+        origin,
+        latency=latency,
+        fallback=fallback,
+        **kw
+    )
@@ -1,12 +1,60 @@
 from zeep.xsd.elements.element import NotSet
 
 DEFAULT_WSDL_CACHE_EXPIRATION = 3600
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_COMPRESS_MIN_SIZE = 8192
+DEFAULT_MAX_CRITERIA_LENGTH = 1024
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_IDENTITY_MAP_SIZE = 1024
+DEFAULT_UPDATE_BATCH_SIZE = 100
+# Limit of the total WSDL size of the definitions in the shared schema store
+DEFAULT_SCHEMA_STORE_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_IDENTITY_MAP_TTL = 60
+
+# Neither response nor request bodies are compressed
+COMPRESSION_OFF = 'off'
+# Response bodies are compressed when NAV supports it, request bodies are not
+COMPRESSION_RESPONSE = 'response'
+# Both response and request bodies are compressed
+COMPRESSION_FULL = 'full'
 
 CODEUNIT = 'Codeunit'
 PAGE = 'Page'
 
 ReadMultiple = 'ReadMultiple'
 CreateMultiple = 'CreateMultiple'
+Read = 'Read'
+ReadByRecId = 'ReadByRecId'
+GetRecIdFromKey = 'GetRecIdFromKey'
+UpdateMultiple = 'UpdateMultiple'
+Delete = 'Delete'
+
+# Functions that are safe to share between identical concurrent calls
+DEFAULT_SINGLE_FLIGHT_FUNCTIONS = frozenset([ReadMultiple])
+
+# Record HTTP traffic to a cassette file
+CASSETTE_RECORD = 'record'
+# Serve HTTP traffic from a cassette file
+CASSETTE_REPLAY = 'replay'
+
+# Raise the error of a failing CreateMultiple call
+ON_ERROR_RAISE = 'raise'
+# Split failing CreateMultiple batches to isolate the invalid entries
+ON_ERROR_BISECT = 'bisect'
+# Run all UpdateMultiple/Delete batches and report the failing ones
+ON_ERROR_REPORT = 'report'
+
+# How `to_builtins` decodes decimal fields
+DECIMAL_DECIMAL = 'decimal'
+DECIMAL_FLOAT = 'float'
+DECIMAL_STR = 'str'
+# How `to_builtins` decodes date, time and datetime fields
+DATES_NATIVE = 'native'
+DATES_ISO = 'iso'
+
+# Characters with a special meaning in NAV filter criteria. Values containing
+# any of these need to be quoted to be matched literally.
+FILTER_SPECIAL_CHARACTERS = frozenset('=<>.&|()*@?\'"')
 
 STRING_VALUE_TO_PYTHON_TYPE_MAPPING = {
     'NotSet': NotSet,
@@ -0,0 +1,103 @@
+"""
+Decode WS responses in worker processes, to put more than one CPU core to
+work on parsing big responses.
+
+Workers receive the raw response body together with the key of the WSDL
+definitions to decode it with, and send back the decoded data as python
+built-in types. The pickled definitions (see `nav.schemas`) are only sent
+along when a worker doesn't hold them yet. Requires Python 3.7+, see
+`SUPPORTED`.
+"""
+import collections
+import concurrent.futures
+import io
+import multiprocessing
+import sys
+
+import zeep
+import zeep.loader
+import zeep.transports
+
+from . import schemas
+from .utils import to_builtins
+
+# NOTE: `ProcessPoolExecutor` only takes a multiprocessing context from
+# Python 3.7, and the workers must be spawned rather than forked
+SUPPORTED = sys.version_info >= (3, 7)
+
+# Maximum amount of loaded WSDL documents to keep per worker process
+MAX_CLIENTS = 32
+
+# Per worker process cache of loaded WSDL documents, least recently used first
+_clients = collections.OrderedDict()
+
+
+class UnknownSchema(Exception):
+    """Raised by a worker that doesn't hold the WSDL definitions of a key"""
+
+
+def make_pool(max_workers):
+    # NOTE: Spawn rather than fork, as the calling process is likely to be
+    # running threads (e.g. for concurrent requests).
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+
+def _get_client(schema_key, schema, strict, huge_tree):
+    if schema_key in _clients:
+        _clients.move_to_end(schema_key)
+    else:
+        if schema is None:
+            raise UnknownSchema(schema_key)
+        transport = zeep.transports.Transport()
+        settings = zeep.Settings(strict=strict, xml_huge_tree=huge_tree)
+        document = schemas.load_document(
+            io.BytesIO(schema),
+            transport,
+            settings,
+        )
+        _clients[schema_key] = zeep.Client(
+            document,
+            transport=transport,
+            settings=settings,
+        )
+        while len(_clients) > MAX_CLIENTS:
+            _clients.popitem(last=False)
+    return _clients[schema_key]
+
+
+def decode_reply(
+    schema_key,
+    schema,
+    strict,
+    huge_tree,
+    binding_name,
+    operation_name,
+    content,
+    decode_policy=None,
+):
+    """Decode the body of a successful WS response into built-in types
+
+    Returns a tuple of whether the response could be decoded, and the decoded
+    data. SOAP faults are not decoded, they are left to the calling process
+    to raise. Pass None as `schema` to use the definitions the worker already
+    holds, which raises `UnknownSchema` when it doesn't.
+    """
+    client = _get_client(schema_key, schema, strict, huge_tree)
+    binding = client.wsdl.bindings[binding_name]
+    operation = binding.get(operation_name)
+
+    doc = zeep.loader.parse_xml(
+        content,
+        client.transport,
+        settings=client.settings,
+    )
+    if doc.find('soap-env:Body/soap-env:Fault', namespaces=binding.nsmap) is not None:
+        return False, None
+    return True, to_builtins(
+        operation.process_reply(doc),
+        default=[],
+        decode_policy=decode_policy,
+    )
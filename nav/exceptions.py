@@ -1,4 +1,7 @@
+import io
+
 import requests
+import zeep.exceptions
 from lxml import etree
 
 
@@ -12,24 +15,69 @@ class InvalidServiceType(Exception):
 class UnsupportedPageFunction(Exception):
     """Raised when an invalid service function is encountered
 
-    I.e. not one of ReadMultiple, CreateMultiple
+    I.e. not one of ReadMultiple, CreateMultiple, UpdateMultiple, Delete,
+    Read, ReadByRecId, GetRecIdFromKey
     """
 
 
+class ResponseTooLarge(Exception):
+    """Raised when a response body exceeds `NAV(..., max_response_size=...)`"""
+
+
+class InteractionNotRecorded(Exception):
+    """Raised when replaying a cassette that lacks a matching request"""
+
+
+class GatewayError(Exception):
+    """Raised when the `nav serve` gateway daemon responds with an error"""
+
+
+class InvalidBatchJobs(ValueError):
+    """Raised when a `nav batch` job file is malformed, see `nav.batch`"""
+
+
 class NAVHTTPError(requests.exceptions.HTTPError):
     """Displays the error details that NAV returns"""
 
-    def __str__(self):
-        try:
-            return ' - '.join(
+    _fault_text = None
+
+    @property
+    def fault_text(self):
+        """The fault code, string and detail of the NAV error, joined by ` - `"""
+        if self._fault_text is None:
+            self._fault_text = ' - '.join(
                 filter(
                     None,
                     (
-                        e.text for e
-                        in etree.fromstring(self.response.text).iter()
-                        if e.tag in ('faultcode', 'faultstring', 'detail')
+                        e.text for _, e
+                        in etree.iterparse(
+                            io.BytesIO(self.response.content),
+                            tag=('faultcode', 'faultstring', 'detail'),
+                        )
                     )
                 )
             )
+        return self._fault_text
+
+    def __str__(self):
+        try:
+            return self.fault_text
         except BaseException:
             return self.response.text
+
+
+def fault_text(exc):
+    """Get the error details NAV gave for a failed WS call
+
+    Handles both `NAVHTTPError` and the `zeep.exceptions.Fault` raised when
+    NAV responds to an operation with a SOAP fault. Falls back to the
+    response body when it isn't XML, e.g. for authentication errors.
+    """
+    if isinstance(exc, NAVHTTPError):
+        try:
+            return exc.fault_text
+        except etree.LxmlError:
+            return str(exc)
+    elif isinstance(exc, zeep.exceptions.Fault):
+        return ' - '.join(filter(None, (exc.code, exc.message)))
+    return str(exc)
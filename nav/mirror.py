@@ -0,0 +1,504 @@
+"""
+Local SQLite replica of a NAV page, to answer repeated reads without making
+requests to NAV.
+
+The table layout is derived from the page's WSDL definition, and queries take
+NAV style filters, e.g::
+
+    mirror = nv.mirror('CustomerList', 'customers.db', index_fields=['Name'])
+    mirror.query({'Name': 'A*|B*', 'Balance_LCY': '1000..'})
+
+Supported filter syntax is `|` (or), `&` (and), `..` (ranges), `<>`, `<`,
+`<=`, `>`, `>=`, `=`, the `*` and `?` wildcards, `@` (case insensitive
+match) and single quoting of literal values.
+"""
+import datetime
+import decimal
+import functools
+import sqlite3
+
+from zeep.xsd.types import builtins as xsd_builtins
+
+from .constants import DEFAULT_PAGE_SIZE, PAGE
+from .wrappers import json
+
+TEXT = 'text'
+INTEGER = 'integer'
+DECIMAL = 'decimal'
+BOOLEAN = 'boolean'
+DATE = 'date'
+DATETIME = 'datetime'
+TIME = 'time'
+JSON = 'json'
+
+# Order matters, as e.g. `Int` subclasses `Integer`
+_XSD_KINDS = (
+    (xsd_builtins.Boolean, BOOLEAN),
+    (xsd_builtins.Integer, INTEGER),
+    (xsd_builtins.Decimal, DECIMAL),
+    (xsd_builtins.Float, DECIMAL),
+    (xsd_builtins.Double, DECIMAL),
+    (xsd_builtins.DateTime, DATETIME),
+    (xsd_builtins.Date, DATE),
+    (xsd_builtins.Time, TIME),
+    (xsd_builtins.String, TEXT),
+)
+
+_SQL_TYPES = {
+    TEXT: 'TEXT',
+    INTEGER: 'INTEGER',
+    # Kept as text for exact round-trips, SQLite would convert NUMERIC values
+    # with a fraction to REAL
+    DECIMAL: 'TEXT',
+    BOOLEAN: 'INTEGER',
+    DATE: 'TEXT',
+    DATETIME: 'TEXT',
+    TIME: 'TEXT',
+    JSON: 'TEXT',
+}
+
+_ISO_FORMATS = {
+    DATE: '%Y-%m-%d',
+    DATETIME: '%Y-%m-%dT%H:%M:%S',
+    TIME: '%H:%M:%S',
+}
+
+
+def _parse_iso(kind, value):
+    """Parse the `isoformat` of a date, datetime or time, for Python < 3.7"""
+    fmt = _ISO_FORMATS[kind]
+    if kind != DATE:
+        if '.' in value:
+            fmt += '.%f'
+        if value[-6:-5] in ('+', '-') and value[-3:-2] == ':':
+            # `%z` only accepts a colon in the UTC offset from Python 3.7
+            value = value[:-3] + value[-2:]
+            fmt += '%z'
+    parsed = datetime.datetime.strptime(value, fmt)
+    if kind == DATE:
+        return parsed.date()
+    elif kind == TIME:
+        return parsed.timetz()
+    return parsed
+
+
+def _iso_parser(cls, kind):
+    # `fromisoformat` is only available from Python 3.7
+    if hasattr(cls, 'fromisoformat'):
+        return cls.fromisoformat
+    return functools.partial(_parse_iso, kind)
+
+
+_FROM_SQL = {
+    DECIMAL: decimal.Decimal,
+    BOOLEAN: bool,
+    DATE: _iso_parser(datetime.date, DATE),
+    DATETIME: _iso_parser(datetime.datetime, DATETIME),
+    TIME: _iso_parser(datetime.time, TIME),
+    JSON: json.loads,
+}
+
+_BOOLEAN_VALUES = {
+    'yes': 1, 'true': 1, '1': 1,
+    'no': 0, 'false': 0, '0': 0,
+}
+
+_OPERATORS = ('<>', '<=', '>=', '<', '>', '=')
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def page_columns(client, service_name):
+    """Get `(field name, kind)` tuples of a page from its WSDL definition"""
+    xsd_type = client.get_type('{{urn:microsoft-dynamics-schemas/page/{}}}{}'.format(
+        service_name.lower(),
+        service_name,
+    ))
+    columns = []
+    for name, element in xsd_type.elements:
+        kind = JSON
+        if element.max_occurs == 1:
+            for cls, xsd_kind in _XSD_KINDS:
+                if isinstance(element.type, cls):
+                    kind = xsd_kind
+                    break
+        columns.append((name, kind))
+    return columns
+
+
+def _to_sql(value):
+    if isinstance(value, bool):
+        return int(value)
+    elif isinstance(value, decimal.Decimal):
+        return str(value)
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def _sql_value(kind, column):
+    """Get an SQL expression comparing a column by its value"""
+    if kind == DECIMAL:
+        return 'CAST({} AS REAL)'.format(column)
+    return column
+
+
+def _tokenize(term):
+    """Split a filter term into `(character, is_literal)` tuples
+
+    Characters within single quotes are literal, `''` being a quote.
+    """
+    tokens = []
+    quoted = False
+    i = 0
+    while i < len(term):
+        char = term[i]
+        if char == "'":
+            if quoted and term[i + 1:i + 2] == "'":
+                tokens.append(("'", True))
+                i += 1
+            else:
+                quoted = not quoted
+        else:
+            tokens.append((char, quoted))
+        i += 1
+    if quoted:
+        raise ValueError('Unterminated quote in filter `{}`'.format(term))
+    return tokens
+
+
+def _split_tokens(tokens, separator):
+    parts = [[]]
+    for char, literal in tokens:
+        if char == separator and not literal:
+            parts.append([])
+        else:
+            parts[-1].append((char, literal))
+    return parts
+
+
+def _text(tokens):
+    return ''.join(char for char, _ in tokens)
+
+
+class FilterBuilder:
+    """Translate NAV style filter criteria into an SQL expression
+
+    Args:
+        columns:
+            Dict of field name to kind, as returned by `page_columns`
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def _value(self, kind, tokens):
+        text = _text(tokens)
+        if kind == BOOLEAN and text.lower() in _BOOLEAN_VALUES:
+            return _BOOLEAN_VALUES[text.lower()]
+        elif kind == DECIMAL:
+            try:
+                return float(decimal.Decimal(text))
+            except decimal.InvalidOperation:
+                raise ValueError('Invalid decimal `{}` in filter'.format(text))
+        return text
+
+    def _pattern(self, tokens, case_insensitive):
+        # GLOB patterns, where literal wildcards are escaped as `[*]`/`[?]`
+        pattern = ''.join(
+            char if char in '*?' and not literal else
+            '[{}]'.format(char) if char in '*?[' else
+            char
+            for char, literal in tokens
+        )
+        return pattern.lower() if case_insensitive else pattern
+
+    def _term(self, column, kind, tokens):
+        case_insensitive = tokens[:1] == [('@', False)]
+        if case_insensitive:
+            tokens = tokens[1:]
+            column = 'LOWER({})'.format(column)
+
+        def value(tokens):
+            v = self._value(kind, tokens)
+            return v.lower() if case_insensitive and isinstance(v, str) else v
+
+        # Decimals are stored as text, so compare them by value instead
+        compared = _sql_value(kind, column)
+        text = ''.join(char if not literal else '\0' for char, literal in tokens)
+        if '..' in text:
+            i = text.index('..')
+            low, high = tokens[:i], tokens[i + 2:]
+            conditions, params = [], []
+            if low:
+                conditions.append('{} >= ?'.format(compared))
+                params.append(value(low))
+            if high:
+                conditions.append('{} <= ?'.format(compared))
+                params.append(value(high))
+            return ' AND '.join(conditions) or '1', params
+
+        for operator in _OPERATORS:
+            if text.startswith(operator):
+                return (
+                    '{} {} ?'.format(compared, '!=' if operator == '<>' else operator),
+                    [value(tokens[len(operator):])],
+                )
+
+        if not tokens:
+            return "IFNULL({}, '') = ''".format(column), []
+        elif '*' in text or '?' in text:
+            return (
+                '{} GLOB ?'.format(column),
+                [self._pattern(tokens, case_insensitive)],
+            )
+        return '{} = ?'.format(compared), [value(tokens)]
+
+    def build(self, field, criteria):
+        """Get `(sql, params)` for the criteria of a field"""
+        if field not in self.columns:
+            raise ValueError('Unknown field `{}`'.format(field))
+        kind = self.columns[field]
+        column = quote_identifier(field)
+
+        tokens = _tokenize(str(criteria))
+        if any(char in '()' and not literal for char, literal in tokens):
+            raise ValueError(
+                'Parentheses are not supported in filter `{}`'.format(criteria)
+            )
+
+        alternatives, params = [], []
+        for alternative in _split_tokens(tokens, '|'):
+            conditions = []
+            for term in _split_tokens(alternative, '&'):
+                sql, term_params = self._term(column, kind, term)
+                conditions.append(sql)
+                params.extend(term_params)
+            alternatives.append('({})'.format(' AND '.join(conditions)))
+        return '({})'.format(' OR '.join(alternatives)), params
+
+
+class Mirror:
+    """SQLite replica of a NAV page
+
+    Args:
+        nv (nav.NAV):
+            The client to read the page with
+        service_name (str):
+            The name of the WS Page
+        db_path (str):
+            Path of the SQLite database, created if missing
+        index_fields (Iterable[str]):
+            Fields to index, for faster queries on them
+        key_fields (Iterable[str]):
+            Fields uniquely identifying an entry, e.g. `['No']`. Required for
+            incremental refreshes
+        since_field (str):
+            A field holding when an entry was last modified, e.g.
+            `Last_Date_Modified`. When set together with `key_fields`,
+            refreshes only read entries modified since the latest value of
+            this field in the replica. Entries deleted in NAV are only removed
+            by a full refresh
+        filters (dict):
+            Only replicate the entries matching these NAV filters
+        page_size (int):
+            Amount of entries to read from NAV per request
+    """
+
+    def __init__(
+        self,
+        nv,
+        service_name,
+        db_path,
+        index_fields=(),
+        key_fields=None,
+        since_field=None,
+        filters=None,
+        page_size=DEFAULT_PAGE_SIZE,
+    ):
+        self.nav = nv
+        self.service_name = service_name
+        self.db_path = db_path
+        self.index_fields = list(index_fields)
+        self.key_fields = list(key_fields or [])
+        self.since_field = since_field
+        self.filters = dict(filters or {})
+        self.page_size = page_size
+
+        self.columns = dict(page_columns(
+            nv._get_client(PAGE, service_name),
+            service_name,
+        ))
+        for field in self.index_fields + self.key_fields + [since_field]:
+            if field is not None and field not in self.columns:
+                raise ValueError('Unknown field `{}`'.format(field))
+
+        self.table = quote_identifier(service_name)
+        self.connection = sqlite3.connect(db_path)
+        self._filter_builder = FilterBuilder(self.columns)
+        self._needs_full_refresh = self._create_table()
+
+    def _create_table(self):
+        """Create the table and indexes, returns whether the table is new"""
+        existing = [
+            (row[1], row[2]) for row
+            in self.connection.execute('PRAGMA table_info({})'.format(self.table))
+        ]
+        wanted = [
+            (name, _SQL_TYPES[kind]) for name, kind in self.columns.items()
+        ]
+        if existing == wanted:
+            created = False
+        else:
+            # The page definition has changed, the replica needs a rebuild
+            with self.connection:
+                self.connection.execute(
+                    'DROP TABLE IF EXISTS {}'.format(self.table),
+                )
+                self.connection.execute('CREATE TABLE {} ({})'.format(
+                    self.table,
+                    ', '.join(
+                        '{} {}'.format(quote_identifier(name), sql_type)
+                        for name, sql_type in wanted
+                    ),
+                ))
+            created = True
+
+        with self.connection:
+            if self.key_fields:
+                self.connection.execute(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                        quote_identifier('ux_{}_key'.format(self.service_name)),
+                        self.table,
+                        ', '.join(map(quote_identifier, self.key_fields)),
+                    )
+                )
+            for field in self.index_fields:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                        quote_identifier('ix_{}_{}'.format(self.service_name, field)),
+                        self.table,
+                        quote_identifier(field),
+                    )
+                )
+        return created
+
+    def _latest_since_value(self):
+        column = quote_identifier(self.since_field)
+        row = self.connection.execute(
+            'SELECT {0} FROM {1} WHERE {0} IS NOT NULL ORDER BY {2} DESC LIMIT 1'.format(
+                column,
+                self.table,
+                _sql_value(self.columns[self.since_field], column),
+            )
+        ).fetchone()
+        return row[0] if row else None
+
+    def refresh(self, full=False):
+        """Update the replica with the current entries of the page
+
+        Does an incremental refresh when possible, see `since_field`, unless
+        `full` is true.
+
+        Returns:
+            A dict with the amount of `entries` read from NAV, and whether the
+            refresh was `incremental`
+        """
+        since = None
+        if (
+            not full and
+            not self._needs_full_refresh and
+            self.since_field and
+            self.key_fields
+        ):
+            since = self._latest_since_value()
+
+        filters = dict(self.filters)
+        if since is not None:
+            filters[self.since_field] = '{}..'.format(since)
+
+        names = list(self.columns)
+        insert = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            self.table,
+            ', '.join(map(quote_identifier, names)),
+            ', '.join('?' for _ in names),
+        )
+
+        count = 0
+        # Everything is done in one transaction, so readers see either the
+        # previous or the refreshed contents
+        with self.connection:
+            if since is None:
+                self.connection.execute('DELETE FROM {}'.format(self.table))
+            rows = []
+            for entry in self.nav.iter_read_multiple(
+                self.service_name,
+                filters=filters,
+                page_size=self.page_size,
+            ):
+                rows.append([_to_sql(entry.get(name)) for name in names])
+                if len(rows) >= self.page_size:
+                    self.connection.executemany(insert, rows)
+                    count += len(rows)
+                    rows = []
+            self.connection.executemany(insert, rows)
+            count += len(rows)
+
+        self._needs_full_refresh = False
+        return {'entries': count, 'incremental': since is not None}
+
+    def _from_sql(self, name, value):
+        convert = _FROM_SQL.get(self.columns[name])
+        if value is None or convert is None:
+            return value
+        return convert(value)
+
+    def query(self, filters=None, order_by=None, limit=None):
+        """Get the entries of the replica matching NAV style filters
+
+        Args:
+            filters (dict):
+                Field name to NAV filter criteria
+            order_by (Iterable[str]):
+                Fields to sort the entries on
+            limit (int):
+                Maximum amount of entries to return
+
+        Returns:
+            A list of entries, in the same form as `nav.NAV.read_multiple`
+        """
+        names = list(self.columns)
+        sql = 'SELECT {} FROM {}'.format(
+            ', '.join(map(quote_identifier, names)),
+            self.table,
+        )
+        conditions, params = [], []
+        for field, criteria in (filters or {}).items():
+            condition, condition_params = self._filter_builder.build(field, criteria)
+            conditions.append(condition)
+            params.extend(condition_params)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if order_by:
+            for field in order_by:
+                if field not in self.columns:
+                    raise ValueError('Unknown field `{}`'.format(field))
+            sql += ' ORDER BY ' + ', '.join(
+                _sql_value(self.columns[field], quote_identifier(field))
+                for field in order_by
+            )
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+
+        return [
+            {name: self._from_sql(name, value) for name, value in zip(names, row)}
+            for row in self.connection.execute(sql, params)
+        ]
+
+    def close(self):
+        self.connection.close()
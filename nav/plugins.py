@@ -1,12 +1,120 @@
 from lxml import etree
 from zeep import Plugin
 
+SOAP_ENVELOPE_NAMESPACES = (
+    'http://schemas.xmlsoap.org/soap/envelope/',
+    'http://www.w3.org/2003/05/soap-envelope',
+)
 
-class RemoveNamespacePlugin(Plugin):
+
+def _body_payloads(envelope):
+    """Get the elements in the SOAP body of an envelope, except faults"""
+    for namespace in SOAP_ENVELOPE_NAMESPACES:
+        body = envelope.find('{%s}Body' % namespace)
+        if body is not None:
+            return [
+                elem for elem in body
+                if isinstance(elem.tag, str) and elem.tag != '{%s}Fault' % namespace
+            ]
+    return []
+
+
+class NamespaceRewritePlugin(Plugin):
+    """Rewrite or remove namespaces in the XML sent to NAV, in a single pass over the envelope.
+
+    Only elements in the given namespaces are visited, and the new tag of each
+    distinct tag is worked out once and then reused. This keeps rewriting
+    cheap for big envelopes, regardless of the amount of namespaces.
+
+    Args:
+        namespaces (Union[Iterable[str], Mapping[str, Optional[str]]]):
+            Namespaces to remove, or a mapping of namespaces to the namespace
+            to replace them with, where None removes the namespace.
+            E.g: ['urn:microsoft-dynamics-nav/xmlports/x50001']
+        ingress (bool):
+            Also apply the reverse mapping to the XML received from NAV, i.e.
+            put elements back in the namespaces they were moved out of. Each
+            target namespace must then be mapped to from a single namespace.
+            Only the payload of the SOAP body is rewritten, the envelope,
+            header and faults are left alone
+    """
+
+    def __init__(self, namespaces, ingress=False):
+        if not hasattr(namespaces, 'items'):
+            namespaces = dict.fromkeys(namespaces)
+        self.namespaces = {
+            namespace: target or None
+            for namespace, target in namespaces.items()
+        }
+        self.reverse_ingress = ingress
+
+        self._egress_patterns = [
+            '{%s}*' % namespace for namespace in self.namespaces
+        ]
+        self._egress_tags = {}
+
+        self._ingress_namespaces = {}
+        for namespace, target in self.namespaces.items():
+            if target in self._ingress_namespaces and ingress:
+                raise ValueError(
+                    'Several namespaces are rewritten to `{}`, so the '
+                    'reverse mapping on ingress is ambiguous'.format(target)
+                )
+            self._ingress_namespaces[target] = namespace
+        self._ingress_patterns = [
+            '{%s}*' % (namespace or '') for namespace in self._ingress_namespaces
+        ]
+        self._ingress_tags = {}
+
+    @staticmethod
+    def _rewrite(roots, patterns, namespaces, tags):
+        # NOTE: `iter` without any patterns would visit every element
+        if not patterns:
+            return
+        for root in roots:
+            for elem in root.iter(*patterns):
+                tag = elem.tag
+                new_tag = tags.get(tag)
+                if new_tag is None:
+                    qname = etree.QName(tag)
+                    target = namespaces[qname.namespace]
+                    new_tag = tags[tag] = (
+                        '{%s}%s' % (target, qname.localname) if target
+                        else qname.localname
+                    )
+                elem.tag = new_tag
+            etree.cleanup_namespaces(root)
+
+    def egress(self, envelope, http_headers, operation, binding_options):
+        self._rewrite(
+            [envelope],
+            self._egress_patterns,
+            self.namespaces,
+            self._egress_tags,
+        )
+        return envelope, http_headers
+
+    def ingress(self, envelope, http_headers, operation):
+        if self.reverse_ingress:
+            # NOTE: Restricted to the payload, as the unqualified pattern
+            # would otherwise match e.g. the `faultcode` of a SOAP fault
+            self._rewrite(
+                _body_payloads(envelope),
+                self._ingress_patterns,
+                self._ingress_namespaces,
+                self._ingress_tags,
+            )
+        return envelope, http_headers
+
+
+class RemoveNamespacePlugin(NamespaceRewritePlugin):
     """Remove a namespace declaration and corresponding prefixes before sending off the XML to NAV.
 
     Useful when NAV complains about `The Element <ns1:XXX> is unexpected` (possibly fixable by using https://support.microsoft.com/en-hk/help/2509042/-the-element-is-unexpected-error-message-when-you-run-certain-xml-port)
 
+    To remove several namespaces, use a single `NamespaceRewritePlugin`
+    rather than one of these per namespace.
+
     Args:
         namespace (str):
             The namespace to remove.
@@ -14,16 +122,5 @@ class RemoveNamespacePlugin(Plugin):
     """
 
     def __init__(self, namespace):
+        super().__init__([namespace])
         self.namespace = namespace
-
-    def egress(self, envelope, http_headers, operation, binding_options):
-        ns = u'{%s}' % self.namespace
-        nsl = len(ns)
-
-        for elem in envelope.getiterator():
-            if elem.tag.startswith(ns):
-                elem.tag = elem.tag[nsl:]
-
-        etree.cleanup_namespaces(envelope)
-
-        return envelope, http_headers
@@ -0,0 +1,166 @@
+"""
+Break down where the time of NAV calls goes, for `nav <command> --profile`
+and the `%navprofile` magic of `nav interact`.
+
+Code paths mark their phases with `phase` and `record`, which do nothing
+unless a `Profile` is running::
+
+    with Profile() as profile:
+        nv.read_multiple('CustomerList')
+    print(profile.report())
+"""
+import collections
+import contextlib
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+IMPORT = 'import'
+CONFIG = 'config'
+WSDL_LOAD = 'wsdl_load'
+AUTH = 'auth'
+REQUEST = 'request'
+SERVER_WAIT = 'server_wait'
+PARSE = 'parse'
+CONVERSION = 'conversion'
+OUTPUT = 'output'
+
+PHASES = (
+    IMPORT,
+    CONFIG,
+    WSDL_LOAD,
+    AUTH,
+    REQUEST,
+    SERVER_WAIT,
+    PARSE,
+    CONVERSION,
+    OUTPUT,
+)
+
+# The running profile, if any
+_active = None
+
+
+def is_active():
+    return _active is not None
+
+
+def record(name, seconds):
+    """Add time spent in a phase to the running profile"""
+    profile = _active
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add the time spent in the block to a phase of the running profile"""
+    profile = _active
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+def record_response(response, seconds):
+    """Split the time spent on an HTTP request into its phases
+
+    Args:
+        response:
+            The `requests.Response`, whose `history` holds the responses of
+            any authentication handshake that preceded it
+        seconds:
+            Time spent on the request, including reading the body
+    """
+    if _active is None:
+        return
+    auth = sum(r.elapsed.total_seconds() for r in response.history)
+    server_wait = response.elapsed.total_seconds()
+    record(AUTH, auth)
+    record(SERVER_WAIT, server_wait)
+    record(REQUEST, max(seconds - auth - server_wait, 0))
+
+
+class Profile:
+    """Collect phase timings, the top functions and the peak memory use
+
+    Only one profile can run at a time. Functions are profiled in the thread
+    that started the profile, while phases are timed in all threads.
+
+    Args:
+        top:
+            Amount of functions to list in the report
+        initial_phases:
+            Phase timings measured before the profile started, e.g. the
+            import of the `nav` package
+    """
+
+    def __init__(self, top=15, initial_phases=None):
+        self.top = top
+        self.phases = collections.OrderedDict((p, 0.0) for p in PHASES)
+        self.phases.update(initial_phases or {})
+        self.seconds = None
+        self.peak_memory = None
+        self._lock = threading.Lock()
+        self._profiler = cProfile.Profile()
+        self._started = None
+        self._trace_memory = False
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('A profile is already running')
+        _active = self
+        self._trace_memory = not tracemalloc.is_tracing()
+        if self._trace_memory:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self._started = time.perf_counter()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        self._profiler.disable()
+        self.seconds = time.perf_counter() - self._started
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if self._trace_memory:
+            tracemalloc.stop()
+        _active = None
+
+    def report(self):
+        """Format the phase timings, peak memory use and top functions"""
+        total = self.seconds + self.phases.get(IMPORT, 0.0)
+        # Phases timed in other threads may overlap
+        other = max(total - sum(self.phases.values()), 0)
+        rows = list(self.phases.items()) + [('other', other), ('total', total)]
+        lines = ['{:<12} {:>9} {:>6}'.format('phase', 'seconds', '%')]
+        for name, seconds in rows:
+            lines.append('{:<12} {:>9.3f} {:>6.1f}'.format(
+                name,
+                seconds,
+                100 * seconds / total if total else 0,
+            ))
+        lines.append('')
+        lines.append('Peak memory: {:.1f} MiB'.format(
+            self.peak_memory / 1024 / 1024,
+        ))
+        lines.append('')
+
+        out = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        lines.append(out.getvalue().strip())
+        return '\n'.join(lines)
@@ -0,0 +1,212 @@
+"""
+Persist fully parsed WSDL definitions on disk, to skip parsing the XML schemas
+of a service each time a client is created.
+
+Artifacts are keyed on the WSDL contents and the versions of this project and
+zeep, so a changed page definition or upgraded dependency results in a new
+artifact rather than a stale one.
+"""
+import copyreg
+import hashlib
+import io
+import logging
+import os
+import os.path as op
+import pickle
+import tempfile
+
+import zeep
+import zeep.settings
+import zeep.transports
+import zeep.wsdl
+from lxml import etree
+from zeep.xsd.types.complex import ComplexType
+
+from ._metadata import __version__
+
+logger = logging.getLogger('nav')
+
+FORMAT_VERSION = 2
+
+# zeep creates classes on the fly for the types it finds in the schemas.
+# These are rebuilt from their name, bases and attributes when unpickling.
+_DYNAMIC_MODULES = ('zeep.xsd.dynamic_types', 'zeep.objects')
+
+_SETTINGS = 'settings'
+_TRANSPORT = 'transport'
+_CLASS = 'class'
+
+
+def _is_dynamic_class(obj):
+    return isinstance(obj, type) and obj.__module__ in _DYNAMIC_MODULES
+
+
+def _make_qname(text):
+    return etree.QName(text)
+
+
+def _make_object(cls):
+    return cls.__new__(cls)
+
+
+def _reduce_complex_type(obj):
+    # Leave out lazily created value classes, they refer back to the type
+    # itself and are recreated on first use anyway.
+    state = {
+        key: value for key, value in vars(obj).items()
+        if not _is_dynamic_class(value)
+    }
+    return _make_object, (type(obj),), state
+
+
+def _reduce_dynamic_object(obj):
+    return _make_object, (type(obj),), vars(obj)
+
+
+class _DocumentPickler(pickle.Pickler):
+    """Pickler of parsed WSDL documents
+
+    NOTE: Classes can't be given custom reducers before Python 3.8, so the
+    dynamic classes are pickled as persistent IDs holding their definition
+    instead, and reducers for the instances of such classes are registered
+    as they are encountered. Both work the same on all Python versions.
+    """
+
+    def __init__(self, *args, **kw):
+        # Set before initializing, as the C pickler reads it when doing so
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        self.dispatch_table[etree.QName] = lambda qname: (_make_qname, (qname.text,))
+        super().__init__(*args, **kw)
+        self._classes = {}
+
+    def persistent_id(self, obj):
+        # Settings and transport belong to the client loading the artifact
+        if isinstance(obj, zeep.settings.Settings):
+            return _SETTINGS
+        elif isinstance(obj, zeep.transports.Transport):
+            return _TRANSPORT
+        elif _is_dynamic_class(obj):
+            # The definition is only pickled on first use, later uses refer
+            # to it by index
+            index, _ = self._classes.get(id(obj), (None, None))
+            if index is not None:
+                return (_CLASS, index)
+            index = len(self._classes)
+            # Keep the class referenced, so that its id isn't reused
+            self._classes[id(obj)] = (index, obj)
+            attrs = {
+                key: value for key, value in vars(obj).items()
+                if key not in ('__dict__', '__weakref__')
+            }
+            return (_CLASS, index, obj.__name__, obj.__bases__, attrs)
+
+        cls = type(obj)
+        if cls not in self.dispatch_table:
+            if isinstance(obj, ComplexType):
+                self.dispatch_table[cls] = _reduce_complex_type
+            elif cls.__module__ in _DYNAMIC_MODULES:
+                self.dispatch_table[cls] = _reduce_dynamic_object
+        return None
+
+
+class _DocumentUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, transport, settings):
+        super().__init__(file)
+        self._persistent = {_SETTINGS: settings, _TRANSPORT: transport}
+        self._classes = {}
+
+    def persistent_load(self, pid):
+        if isinstance(pid, tuple) and pid[0] == _CLASS:
+            if len(pid) == 2:
+                return self._classes[pid[1]]
+            _, index, name, bases, attrs = pid
+            cls = self._classes[index] = type(name, bases, attrs)
+            return cls
+        return self._persistent[pid]
+
+
+def dump_document(document, file):
+    """Pickle a parsed `zeep.wsdl.Document` into a binary file"""
+    _DocumentPickler(file, pickle.HIGHEST_PROTOCOL).dump(document)
+
+
+def load_document(file, transport, settings):
+    """Unpickle a `zeep.wsdl.Document` written by `dump_document`
+
+    The document is attached to the given transport and settings.
+    """
+    return _DocumentUnpickler(file, transport, settings).load()
+
+
+def artifact_path(cache_dir, wsdl_content):
+    key = hashlib.sha256()
+    key.update(wsdl_content)
+    key.update('{}:{}:{}'.format(
+        FORMAT_VERSION,
+        __version__,
+        zeep.__version__,
+    ).encode())
+    return op.join(cache_dir, key.hexdigest() + '.pickle')
+
+
+def parse_document(url, content, transport, settings):
+    """Parse the already fetched WSDL contents of a URL"""
+    return zeep.wsdl.Document(
+        io.BytesIO(content),
+        transport,
+        base=url,
+        settings=settings,
+    )
+
+
+def load_or_parse_document(
+    url,
+    transport,
+    settings,
+    cache_dir,
+    content=None,
+    stats=None,
+):
+    """Get the parsed WSDL document of a URL, from disk when possible
+
+    Parses the WSDL and writes a new artifact to `cache_dir` when there is
+    no usable artifact for the current WSDL contents. Pass the `content` of
+    the WSDL when it has already been fetched. Hits and misses are counted
+    in `stats`, which defaults to the stats of `transport`.
+    """
+    if content is None:
+        content = transport.load(url)
+    path = artifact_path(cache_dir, content)
+    if stats is None:
+        stats = getattr(transport, 'stats', None)
+
+    try:
+        with open(path, 'rb') as f:
+            document = load_document(f, transport, settings)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.warning('Discarding unusable schema artifact %s', path, exc_info=True)
+    else:
+        if stats is not None:
+            stats.incr('schema_cache_hits')
+        return document
+
+    if stats is not None:
+        stats.incr('schema_cache_misses')
+    document = parse_document(url, content, transport, settings)
+
+    # Write to a temporary file first, so that concurrent processes never
+    # read a partially written artifact.
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            dump_document(document, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        logger.warning('Unable to write schema artifact %s', path, exc_info=True)
+
+    return document
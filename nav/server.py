@@ -0,0 +1,352 @@
+"""
+Local gateway daemon that keeps warm NAV clients, i.e. clients that have
+already fetched WSDL definitions and authenticated, and exposes their page and
+codeunit calls as JSON over HTTP.
+
+The daemon is started with `nav serve` and used by passing `--via-daemon` to
+the `nav page` and `nav codeunit` commands, or by calling `forward`.
+
+Requests are POSTed as JSON objects to `/page`, `/read_multiple` or
+`/codeunit` and take the same arguments as the `nav.NAV` methods of the same
+name, plus `config_section`. String values of filters, entries and arguments
+are converted like on the command line, e.g. `TRUE` becomes `True`.
+`ReadMultiple` calls without `num_results` are read from NAV in chunks of
+`page_size` and streamed back entry by entry, so the daemon never holds the
+whole result in memory.
+
+The daemon listens on localhost over TCP, or on a Unix socket with
+`UnixGatewayServer`. Forward to the latter with a `unix:<path>` daemon URL.
+
+NOTE: Anyone able to connect to the daemon can make calls with its
+credentials. Prefer the Unix socket, which is only accessible to the user
+running the daemon. Over TCP, only bind to a local interface. Requests must
+be sent as `application/json` to a loopback `Host` and without an `Origin`,
+so that web pages can't make calls through the daemon, neither directly nor
+by DNS rebinding.
+"""
+import collections.abc
+import http.client
+import http.server
+import ipaddress
+import itertools
+import json as json_impl
+import logging
+import os
+import socket
+import socketserver
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import zeep.exceptions
+
+from . import exceptions
+from .constants import DEFAULT_PAGE_SIZE, ReadMultiple
+from .utils import convert_string_filter_values
+from .wrappers import json
+
+logger = logging.getLogger('nav')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7047
+DAEMON_URL = os.environ.get(
+    'NAV_DAEMON_URL',
+    'http://{}:{}'.format(DEFAULT_HOST, DEFAULT_PORT),
+)
+
+
+def _convert_mapping(data):
+    return convert_string_filter_values(data or {})
+
+
+def _stream_read_multiple(nv, params):
+    return nv.iter_read_multiple(
+        service_name=params['service_name'],
+        filters=_convert_mapping(params.get('filters')),
+        page_size=int(params.get('page_size') or DEFAULT_PAGE_SIZE),
+        additional_data=_convert_mapping(params.get('additional_data')),
+    )
+
+
+def _page(nv, params):
+    if params['function'] == ReadMultiple and not params.get('num_results'):
+        return _stream_read_multiple(nv, params)
+    return nv.page(
+        service_name=params['service_name'],
+        function=params['function'],
+        num_results=int(params.get('num_results') or 0),
+        filters=_convert_mapping(params.get('filters')),
+        entries=[_convert_mapping(e) for e in params.get('entries') or []],
+        additional_data=_convert_mapping(params.get('additional_data')),
+    )
+
+
+def _read_multiple(nv, params):
+    if not params.get('num_results'):
+        return _stream_read_multiple(nv, params)
+    return nv.read_multiple(
+        service_name=params['service_name'],
+        num_results=int(params.get('num_results') or 0),
+        filters=_convert_mapping(params.get('filters')),
+        additional_data=_convert_mapping(params.get('additional_data')),
+    )
+
+
+def _codeunit(nv, params):
+    return nv.codeunit(
+        service_name=params['service_name'],
+        function=params['function'],
+        func_args=_convert_mapping(params.get('func_args')),
+    )
+
+
+ENDPOINTS = {
+    '/page': _page,
+    '/read_multiple': _read_multiple,
+    '/codeunit': _codeunit,
+}
+
+
+class GatewayRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def _stream_json_list(self, entries):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self._write_chunk(b'[')
+        try:
+            for i, entry in enumerate(entries):
+                self._write_chunk(
+                    (',' if i else '').encode() + json.dumps(entry).encode('utf-8')
+                )
+        except Exception:
+            # The status is already sent, so leave the response incomplete
+            # for the client to notice
+            logger.exception('Error streaming %s', self.path)
+            self.close_connection = True
+            return
+        self._write_chunk(b']')
+        self._write_chunk(b'')
+
+    def _is_local_host(self):
+        try:
+            host = urllib.parse.urlsplit('//' + self.headers['Host']).hostname
+        except (TypeError, ValueError):
+            return False
+        if host == 'localhost':
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+
+    def _reject(self):
+        """Get the reason to refuse a call, if any"""
+        if self.headers.get_content_type() != 'application/json':
+            return 415, 'Content-Type must be application/json'
+        elif 'Origin' in self.headers:
+            return 403, 'Calls from web pages are not allowed'
+        elif self.server.check_host and not self._is_local_host():
+            return 403, 'Host must be a loopback address'
+        return None
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'config_sections': sorted(self.server.navs)})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        endpoint = ENDPOINTS.get(self.path)
+        if endpoint is None:
+            self._send_json(404, {'error': 'Not found'})
+            return
+
+        rejection = self._reject()
+        if rejection is not None:
+            # NOTE: The body is left unread, so the connection can't be reused
+            self.close_connection = True
+            self._send_json(rejection[0], {'error': rejection[1]})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json_impl.loads(self.rfile.read(length) or b'{}')
+            section = params.get('config_section', 'nav')
+            nv = self.server.navs[section]
+        except KeyError:
+            self._send_json(400, {'error': 'Unknown config section'})
+            return
+        except ValueError as exc:
+            self._send_json(400, {'error': str(exc)})
+            return
+
+        try:
+            data = endpoint(nv, params)
+            if isinstance(data, collections.abc.Iterator):
+                # Fail with a proper status when the first request does
+                first = list(itertools.islice(data, 1))
+                data = itertools.chain(first, data)
+        except (zeep.exceptions.Fault, exceptions.NAVHTTPError) as exc:
+            self._send_json(502, {'error': exceptions.fault_text(exc)})
+        except (KeyError, TypeError, ValueError) as exc:
+            self._send_json(400, {'error': '{}: {}'.format(type(exc).__name__, exc)})
+        except Exception as exc:
+            logger.exception('Error handling %s', self.path)
+            self._send_json(500, {'error': '{}: {}'.format(type(exc).__name__, exc)})
+        else:
+            if isinstance(data, (list, collections.abc.Iterator)):
+                self._stream_json_list(data)
+            else:
+                self._send_json(200, data)
+
+
+# NOTE: `http.server.ThreadingHTTPServer` is only available from Python 3.7
+class GatewayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server keeping warm NAV clients
+
+    Args:
+        server_address:
+            `(host, port)` to listen on
+        navs:
+            Dict of config section name to the `nav.NAV` instance to use for
+            requests to that section
+    """
+
+    daemon_threads = True
+    check_host = True
+
+    def __init__(self, server_address, navs):
+        super().__init__(server_address, GatewayRequestHandler)
+        self.navs = navs
+
+
+class _UnixGatewayRequestHandler(GatewayRequestHandler):
+
+    def address_string(self):
+        return self.server.server_address
+
+
+class UnixGatewayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server keeping warm NAV clients, listening on a Unix socket
+
+    The socket is only accessible to the user running the server.
+
+    Args:
+        path:
+            Path of the socket to create
+        navs:
+            Dict of config section name to the `nav.NAV` instance to use for
+            requests to that section
+    """
+
+    daemon_threads = True
+    # Access is controlled by the permissions of the socket instead
+    check_host = False
+
+    def __init__(self, path, navs):
+        self.navs = navs
+        super().__init__(path, _UnixGatewayRequestHandler, bind_and_activate=False)
+        try:
+            old_umask = os.umask(0o177)
+            try:
+                self.server_bind()
+            finally:
+                os.umask(old_umask)
+            self.server_activate()
+        except BaseException:
+            self.server_close()
+            raise
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def _post_unix(path, endpoint, body):
+    connection = _UnixHTTPConnection(path)
+    try:
+        connection.request(
+            'POST',
+            '/' + endpoint,
+            body=body,
+            headers={'Content-Type': 'application/json'},
+        )
+        response = connection.getresponse()
+        data = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        try:
+            message = json.loads(data)['error']
+        except (ValueError, KeyError):
+            message = '{} {}'.format(response.status, response.reason)
+        raise exceptions.GatewayError(message)
+    return json.loads(data)
+
+
+def forward(endpoint, daemon_url=DAEMON_URL, **params):
+    """Make a call through a running gateway daemon
+
+    Args:
+        endpoint:
+            "page", "read_multiple" or "codeunit"
+        daemon_url:
+            Where the daemon listens, e.g. http://127.0.0.1:7047 or
+            unix:/path/to/socket. Defaults to the environment variable
+            `NAV_DAEMON_URL`, or http://127.0.0.1:7047
+        **params:
+            Arguments of the `nav.NAV` method, plus `config_section`
+
+    """
+    if daemon_url.startswith('unix:'):
+        return _post_unix(
+            daemon_url[len('unix:'):],
+            endpoint,
+            json.dumps(params).encode('utf-8'),
+        )
+    request = urllib.request.Request(
+        '{}/{}'.format(daemon_url.rstrip('/'), endpoint),
+        data=json.dumps(params).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST',
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as exc:
+        try:
+            message = json.load(exc)['error']
+        except (ValueError, KeyError):
+            message = str(exc)
+        raise exceptions.GatewayError(message)
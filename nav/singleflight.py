@@ -0,0 +1,72 @@
+import threading
+
+
+def freeze(value):
+    """Turn (nested) call arguments into a hashable key"""
+    if isinstance(value, dict):
+        return tuple(sorted(
+            ((freeze(k), freeze(v)) for k, v in value.items()),
+            key=repr,
+        ))
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    if type(value).__hash__ is object.__hash__:
+        # Hashed by identity, e.g. `zeep.helpers.Nil()`, so compare the
+        # representation instead
+        return repr(value)
+    return value
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Let concurrent calls with the same key share a single execution
+
+    The first caller of a key runs the function, while callers arriving before
+    it has finished wait for, and get, the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fun):
+        """Run `fun` unless a call with the same key is already in flight
+
+        Returns:
+            A tuple of the result and whether it was shared from another call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fun()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
@@ -0,0 +1,37 @@
+import collections
+import threading
+
+
+class Stats:
+    """Thread-safe counters describing the traffic of a NAV client
+
+    Counters are created on first use and default to 0, e.g::
+
+        >>> stats = Stats()
+        >>> stats.incr('requests')
+        >>> stats['requests']
+        1
+    """
+
+    def __init__(self):
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def __repr__(self):
+        return '<Stats {!r}>'.format(self.as_dict())
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
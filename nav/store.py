@@ -0,0 +1,146 @@
+"""
+Process-wide store of parsed WSDL definitions, shared by all `NAV` instances.
+
+Definitions are keyed on the WSDL contents, so that identical page and
+codeunit definitions are parsed and held once, no matter how many tenants or
+companies use them. Definitions stay in the store while in use by a zeep
+client. Unused ones are kept until the store grows over its size limit, and
+then evicted least recently used first.
+"""
+import collections
+import hashlib
+import logging
+import threading
+import weakref
+
+from .constants import DEFAULT_SCHEMA_STORE_MAX_BYTES
+from .singleflight import SingleFlight
+
+logger = logging.getLogger('nav')
+
+# zeep settings that affect how the WSDL is parsed
+_SETTINGS_KEYS = (
+    'strict',
+    'xml_huge_tree',
+    'xsd_ignore_sequence_order',
+    'forbid_dtd',
+    'forbid_entities',
+    'forbid_external',
+    'force_https',
+)
+
+
+class _Entry:
+
+    def __init__(self, document, size):
+        self.document = document
+        self.size = size
+        self.refs = 0
+
+
+class SchemaStore:
+    """Reference counted, size bounded store of parsed WSDL documents
+
+    Args:
+        max_bytes:
+            Size limit of the store, measured as the total size of the WSDL
+            contents of the documents held, which is what their parsed size
+            grows with. Documents in use are never evicted, so the store may
+            exceed the limit when they alone do
+    """
+
+    def __init__(self, max_bytes=DEFAULT_SCHEMA_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def size(self):
+        """Total size of the WSDL contents of the held documents"""
+        with self._lock:
+            return self._size
+
+    @staticmethod
+    def make_key(content, settings):
+        return (
+            hashlib.sha256(content).hexdigest(),
+            tuple(getattr(settings, name, None) for name in _SETTINGS_KEYS),
+        )
+
+    def acquire(self, content, settings, parse):
+        """Get the document for WSDL contents, parsing it when not held yet
+
+        Concurrent callers for the same contents share a single parse. Each
+        call must be paired with a `release` of the returned key, see `bind`.
+
+        Args:
+            content:
+                The WSDL contents
+            settings:
+                The `zeep.Settings` to parse with
+            parse:
+                Function returning the parsed `zeep.wsdl.Document`
+
+        Returns:
+            A tuple of the key, the document and whether it was held already
+        """
+        key = self.make_key(content, settings)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refs += 1
+                self._entries.move_to_end(key)
+                return key, entry.document, True
+
+        document, _ = self._single_flight.do(key, parse)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry(document, len(content))
+                self._size += entry.size
+            entry.refs += 1
+            self._entries.move_to_end(key)
+            self._evict()
+            return key, entry.document, False
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs -= 1
+            self._evict()
+
+    def bind(self, owner, key):
+        """Release the document of `key` once `owner` is garbage collected"""
+        weakref.finalize(owner, self.release, key)
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        for key, entry in list(self._entries.items()):
+            if self._size <= self.max_bytes:
+                break
+            if entry.refs <= 0:
+                del self._entries[key]
+                self._size -= entry.size
+                logger.debug('Evicted WSDL document %s from schema store', key[0])
+
+    def clear(self):
+        """Drop all documents that are not in use"""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.refs <= 0:
+                    del self._entries[key]
+                    self._size -= entry.size
+
+
+# Shared by all `NAV` instances of the process
+default_store = SchemaStore()
@@ -0,0 +1,263 @@
+import contextlib
+import gzip
+import logging
+import tempfile
+import time
+
+import requests
+import zeep.exceptions
+import zeep.loader
+import zeep.plugins
+import zeep.transports
+import zeep.utils
+from lxml import etree
+
+from . import exceptions
+from . import profiling
+from .stats import Stats
+
+CHUNK_SIZE = 64 * 1024
+
+
+class NAVTransport(zeep.transports.Transport):
+    """zeep transport that keeps count of the traffic to NAV
+
+    Args:
+        stats (nav.stats.Stats):
+            Where to record the amount of requests and bytes transferred.
+            `*_bytes` counters hold the uncompressed sizes, while
+            `*_wire_bytes` counters hold the sizes actually transferred.
+        compress_requests (bool):
+            Whether or not to gzip request bodies
+        compress_min_size (int):
+            Only gzip request bodies of at least this many bytes
+        spool_threshold (int):
+            Stream response bodies into a temporary file, kept in memory until
+            it grows beyond this many bytes and on disk after that. The body of
+            such responses is available as a file in `response.raw` and can be
+            parsed with `process_spooled_reply`. None disables spooling
+        max_response_size (int):
+            Raise `nav.exceptions.ResponseTooLarge` rather than reading
+            response bodies larger than this many bytes. None means no limit
+    """
+
+    def __init__(
+        self,
+        *args,
+        stats=None,
+        compress_requests=False,
+        compress_min_size=0,
+        spool_threshold=None,
+        max_response_size=None,
+        **kw
+    ):
+        super().__init__(*args, **kw)
+        self.stats = stats if stats is not None else Stats()
+        self.compress_requests = compress_requests
+        self.compress_min_size = compress_min_size
+        self.spool_threshold = spool_threshold
+        self.max_response_size = max_response_size
+
+    @property
+    def streaming(self):
+        return (
+            self.spool_threshold is not None or
+            self.max_response_size is not None
+        )
+
+    @staticmethod
+    def _wire_size(response):
+        try:
+            return response.raw.tell()
+        except AttributeError:
+            return int(
+                response.headers.get('Content-Length', len(response.content))
+            )
+
+    def _record_response(self, response, prefix):
+        self.stats.incr(prefix + '_bytes', len(response.content))
+        self.stats.incr(prefix + '_wire_bytes', self._wire_size(response))
+
+    def _check_response_size(self, response, size):
+        if self.max_response_size is not None and size > self.max_response_size:
+            response.close()
+            raise exceptions.ResponseTooLarge(
+                'Response from {} is larger than the maximum of {} bytes'
+                .format(response.url, self.max_response_size)
+            )
+
+    def _spool_response(self, response):
+        """Read the body of a streamed response into a temporary file
+
+        Returns a new response object with the file as `raw`.
+        """
+        self._check_response_size(
+            response,
+            int(response.headers.get('Content-Length', 0)),
+        )
+
+        # NOTE: A max_size of 0 keeps the file in memory regardless of size
+        spool = tempfile.SpooledTemporaryFile(
+            max_size=self.spool_threshold or 0,
+        )
+        size = 0
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                self._check_response_size(response, size)
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+
+        self.stats.incr('response_bytes', size)
+        self.stats.incr('response_wire_bytes', self._wire_size(response))
+        if self.spool_threshold is not None and size > self.spool_threshold:
+            self.stats.incr('spooled_responses')
+
+        spooled = requests.Response()
+        for attr in (
+            'status_code', 'headers', 'url', 'encoding', 'history',
+            'reason', 'cookies', 'elapsed', 'request',
+        ):
+            setattr(spooled, attr, getattr(response, attr))
+        spooled.raw = spool
+        return spooled
+
+    def post(self, address, message, headers):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                'HTTP Post to %s:\n%s',
+                address,
+                message.decode('utf-8'),
+            )
+
+        self.stats.incr('requests')
+        self.stats.incr('request_bytes', len(message))
+
+        if self.compress_requests and len(message) >= self.compress_min_size:
+            message = gzip.compress(message)
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+
+        self.stats.incr('request_wire_bytes', len(message))
+
+        started = time.perf_counter()
+        response = self.session.post(
+            address,
+            data=message,
+            headers=headers,
+            timeout=self.operation_timeout,
+            stream=self.streaming,
+        )
+        if self.streaming:
+            response = self._spool_response(response)
+            profiling.record_response(response, time.perf_counter() - started)
+            return response
+        profiling.record_response(response, time.perf_counter() - started)
+
+        self._record_response(response, 'response')
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                'HTTP Response from %s (status: %d):\n%s',
+                address,
+                response.status_code,
+                response.text,
+            )
+
+        return response
+
+    def _load_remote_data(self, url):
+        self.logger.debug('Loading remote data from: %s', url)
+        response = self.session.get(url, timeout=self.load_timeout)
+        with contextlib.closing(response):
+            response.raise_for_status()
+            content = response.content
+        # Tell the authentication handshake apart from the WSDL load it is
+        # part of
+        auth = sum(r.elapsed.total_seconds() for r in response.history)
+        profiling.record(profiling.AUTH, auth)
+        profiling.record(profiling.WSDL_LOAD, -auth)
+        self.stats.incr('wsdl_requests')
+        self.stats.incr('wsdl_bytes', len(content))
+        return content
+
+
+def _check_docinfo(doc, settings):
+    """Apply the DTD and entity checks of `zeep.loader.parse_xml`"""
+    docinfo = doc.getroottree().docinfo
+    if docinfo.doctype and settings.forbid_dtd:
+        raise zeep.exceptions.DTDForbidden(
+            docinfo.doctype, docinfo.system_url, docinfo.public_id,
+        )
+    if settings.forbid_entities:
+        for dtd in docinfo.internalDTD, docinfo.externalDTD:
+            if dtd is None:
+                continue
+            for entity in dtd.iterentities():
+                raise zeep.exceptions.EntitiesForbidden(entity.name, entity.content)
+
+
+def process_spooled_reply(client, binding, operation_name, response):
+    """Parse a response spooled by `NAVTransport`
+
+    Equivalent to `zeep.wsdl.bindings.soap.SoapBinding.process_reply`, except
+    that the XML is parsed straight from the spooled file, so the body never
+    needs to be held in memory as a whole. Multipart responses are handed to
+    `process_reply` as is.
+    """
+    operation = binding.get(operation_name)
+
+    content_type = response.headers.get('Content-Type', 'text/xml')
+    if zeep.utils.get_media_type(content_type) == 'multipart/related':
+        return binding.process_reply(client, operation, response)
+
+    empty = not response.raw.read(1)
+    response.raw.seek(0)
+    if empty:
+        response.raw.close()
+        if response.status_code in (201, 202):
+            return None
+        raise zeep.exceptions.TransportError(
+            'Server returned HTTP status {} (no content available)'
+            .format(response.status_code),
+            status_code=response.status_code,
+        )
+
+    parser = etree.XMLParser(
+        remove_comments=True,
+        resolve_entities=False,
+        recover=not client.settings.strict,
+        huge_tree=client.settings.xml_huge_tree,
+    )
+    parser.resolvers.add(
+        zeep.loader.ImportResolver(client.transport, client.settings),
+    )
+    try:
+        doc = etree.parse(response.raw, parser).getroot()
+    except etree.XMLSyntaxError as exc:
+        raise zeep.exceptions.TransportError(
+            'Server returned response ({}) with invalid XML: {}'
+            .format(response.status_code, exc),
+            status_code=response.status_code,
+        )
+    finally:
+        response.raw.close()
+    _check_docinfo(doc, client.settings)
+
+    if client.wsse:
+        client.wsse.verify(doc)
+
+    doc, _ = zeep.plugins.apply_ingress(
+        client, doc, response.headers, operation,
+    )
+
+    fault_node = doc.find('soap-env:Body/soap-env:Fault', namespaces=binding.nsmap)
+    if response.status_code != 200 or fault_node is not None:
+        return binding.process_error(doc, operation)
+
+    return operation.process_reply(doc)
@@ -1,9 +1,18 @@
-import zeep.helpers
+import datetime
+import decimal
+import queue
+import threading
+
+import zeep.xsd
 
 from . import constants
 
 UNSET = object()
 
+_ITEM = 'item'
+_ERROR = 'error'
+_DONE = 'done'
+
 
 def convert_string_filter_values(filters):
     """Convert string type filter values to their XML equivalent
@@ -18,7 +27,104 @@ def convert_string_filter_values(filters):
     }
 
 
-def to_builtins(data, default=UNSET, target_cls=dict):
+def quote_filter_value(value):
+    """Quote a value to have it matched literally in NAV filter criteria
+
+    E.g. `A|B` becomes `'A|B'`, while `1001` is returned as is.
+    """
+    value = str(value)
+    if (
+        not value or
+        value != value.strip() or
+        not constants.FILTER_SPECIAL_CHARACTERS.isdisjoint(value)
+    ):
+        return "'{}'".format(value.replace("'", "''"))
+    return value
+
+
+def chunk_filter_criteria(values, max_length):
+    """Join values into `|` separated NAV filter criteria
+
+    Yields criteria like `1001|1002|1003`, each of them at most `max_length`
+    characters long unless a single value is longer than that.
+    """
+    chunk = []
+    length = 0
+    for value in values:
+        quoted = quote_filter_value(value)
+        if chunk and length + 1 + len(quoted) > max_length:
+            yield '|'.join(chunk)
+            chunk = []
+            length = 0
+        length += len(quoted) + (1 if chunk else 0)
+        chunk.append(quoted)
+    if chunk:
+        yield '|'.join(chunk)
+
+
+def make_value_converters(decode_policy):
+    """Get the functions to convert leaf values with, keyed on their type
+
+    Args:
+        decode_policy (dict):
+            How to decode values, e.g. `{'decimal': 'float', 'dates': 'iso'}`.
+            `decimal` is one of "decimal" (the default), "float" or "str",
+            and `dates` is one of "native" (the default) or "iso". A falsy
+            value keeps all values as zeep decoded them.
+    """
+    decode_policy = dict(decode_policy or {})
+    decimal_policy = decode_policy.pop('decimal', constants.DECIMAL_DECIMAL)
+    dates_policy = decode_policy.pop('dates', constants.DATES_NATIVE)
+    if decode_policy:
+        raise ValueError(
+            'Unknown decode policy keys {}, must be one of {}'
+            .format(sorted(decode_policy), ('decimal', 'dates'))
+        )
+
+    decimal_converters = {
+        constants.DECIMAL_DECIMAL: None,
+        constants.DECIMAL_FLOAT: float,
+        constants.DECIMAL_STR: str,
+    }
+    if decimal_policy not in decimal_converters:
+        raise ValueError(
+            '`{}` is not a valid decimal policy, must be one of {}'
+            .format(decimal_policy, tuple(decimal_converters))
+        )
+    allowed_dates_policies = (constants.DATES_NATIVE, constants.DATES_ISO)
+    if dates_policy not in allowed_dates_policies:
+        raise ValueError(
+            '`{}` is not a valid dates policy, must be one of {}'
+            .format(dates_policy, allowed_dates_policies)
+        )
+
+    converters = {}
+    if decimal_converters[decimal_policy] is not None:
+        converters[decimal.Decimal] = decimal_converters[decimal_policy]
+    if dates_policy == constants.DATES_ISO:
+        for cls in (datetime.date, datetime.datetime, datetime.time):
+            converters[cls] = cls.isoformat
+    return converters
+
+
+def _to_builtins(obj, target_cls, converters):
+    if isinstance(obj, list):
+        return [_to_builtins(sub, target_cls, converters) for sub in obj]
+
+    if isinstance(obj, (dict, zeep.xsd.CompoundValue)):
+        result = target_cls()
+        for key in obj:
+            result[key] = _to_builtins(obj[key], target_cls, converters)
+        return result
+
+    if converters:
+        convert = converters.get(type(obj))
+        if convert is not None:
+            return convert(obj)
+    return obj
+
+
+def to_builtins(data, default=UNSET, target_cls=dict, decode_policy=None):
     """
     Turn zeep XML object into python built-in data structures
 
@@ -30,8 +136,59 @@ def to_builtins(data, default=UNSET, target_cls=dict):
             As this project's minimum Python version officially supported is
             3.6 we can rely on the native sorted order of the standard `dict`
             class as a default.
+        decode_policy (dict):
+            Convert decimals and dates while walking the data, e.g.
+            `{'decimal': 'float', 'dates': 'iso'}` gives JSON ready data.
+            See `make_value_converters`.
     """
-    d = zeep.helpers.serialize_object(data)
-    if d is None and default is not UNSET:
+    if data is None and default is not UNSET:
         return default
-    return zeep.helpers.serialize_object(d, target_cls=target_cls)
+    return _to_builtins(data, target_cls, make_value_converters(decode_policy))
+
+
+def prefetch_iter(iterable, size):
+    """Consume an iterable in a background thread, up to `size` items ahead
+
+    Exceptions are raised to the consumer when it reaches them. Closing the
+    returned generator stops the background thread, after any item it is
+    busy producing.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    iterator = iter(iterable)
+
+    def produce():
+        try:
+            for item in iterator:
+                items.put((_ITEM, item))
+                if stop.is_set():
+                    return
+        except BaseException as exc:
+            items.put((_ERROR, exc))
+        else:
+            items.put((_DONE, None))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, name='nav-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == _ITEM:
+                yield value
+            elif kind == _ERROR:
+                raise value
+            else:
+                return
+    finally:
+        stop.set()
+        # Make room for the item the producer may be blocked on. It checks
+        # `stop` right after, so it adds no more than that one.
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
+        thread.join()
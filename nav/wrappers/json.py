@@ -8,6 +8,8 @@ import decimal
 from json import JSONDecodeError  # noqa
 import json as json_impl
 
+from .. import profiling
+
 
 class JsonExtendedEncoder(json_impl.JSONEncoder):
     """
@@ -40,13 +42,15 @@ class JsonExtendedEncoder(json_impl.JSONEncoder):
 def dump(*args, **kw):
     if 'cls' not in kw:
         kw['cls'] = JsonExtendedEncoder
-    return json_impl.dump(*args, **kw)
+    with profiling.phase(profiling.OUTPUT):
+        return json_impl.dump(*args, **kw)
 
 
 def dumps(*args, **kw):
     if 'cls' not in kw:
         kw['cls'] = JsonExtendedEncoder
-    return json_impl.dumps(*args, **kw)
+    with profiling.phase(profiling.OUTPUT):
+        return json_impl.dumps(*args, **kw)
 
 
 load = json_impl.load
@@ -1,12 +1,33 @@
+import datetime
+import decimal
+import gzip
+import json
 import os
 import re
+import socket
 import subprocess as subp
+import threading
+import urllib.error
+import urllib.request
 
+import argh
 import lxml.etree
 import pytest
+import requests
 import responses
+import zeep
+import zeep.exceptions
 
 import nav
+import nav.__main__
+import nav.batch
+import nav.decoding
+import nav.mirror
+import nav.profiling
+import nav.schemas
+import nav.server
+import nav.singleflight
+import nav.store
 
 BASE_URL = 'http://navtest:7080/DynamicsNAV/WS/CRONUS-Company-Ltd/'
 
@@ -60,8 +81,30 @@ CODEUNIT_RESPONSE_DATA = """
 """
 
 
+FAULT_RESPONSE_DATA = b"""
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+  <s:Body>
+    <s:Fault>
+      <faultcode xmlns:a="urn:microsoft-dynamics-schemas/error">a:Microsoft.Dynamics.Nav.Types.Exceptions.NavCSideException</faultcode>
+      <faultstring xml:lang="en-US">Customer No. must have a value</faultstring>
+      <detail><string xmlns="http://schemas.microsoft.com/2003/10/Serialization/">Customer No. must have a value</string></detail>
+    </s:Fault>
+  </s:Body>
+</s:Envelope>
+"""
+
+
 def dummy_request_callback(request):
-    if '/Codeunit' in request.url:
+    headers = {}
+    body = request.body
+    if request.headers.get('Content-Encoding') == 'gzip':
+        # Make sure that a gzipped request body is a valid envelope
+        body = gzip.decompress(body)
+        lxml.etree.fromstring(body)
+
+    if b'INVALID' in body:
+        return (500, headers, FAULT_RESPONSE_DATA)
+    elif '/Codeunit' in request.url:
         data = CODEUNIT_RESPONSE_DATA
     elif '/Page/' in request.url:
         if nav.CreateMultiple in request.headers['SOAPAction']:
@@ -70,7 +113,212 @@ def dummy_request_callback(request):
             data = PAGE_READMULTIPLE_RESPONSE_DATA
     else:
         raise RuntimeError
-    return (200, {}, data)
+
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        data = gzip.compress(data.encode())
+    return (200, headers, data)
+
+
+PAGE_NS = 'urn:microsoft-dynamics-schemas/page/customerlist'
+
+
+def make_customers(amount):
+    return [
+        {
+            'Key': 'KEY{}'.format(i),
+            'No': 'C{:02d}'.format(i),
+            'Name': 'Customer #{}'.format(i),
+            'Balance_LCY': '{}.50'.format(i * 100),
+            'Blocked': 'true' if i % 2 else 'false',
+            'Last_Date_Modified': '2019-01-{:02d}'.format(i),
+        }
+        for i in range(1, amount + 1)
+    ]
+
+
+def matches_criteria(value, criteria):
+    for alternative in criteria.split('|'):
+        if '..' in alternative:
+            low, high = alternative.split('..')
+            if (not low or value >= low) and (not high or value <= high):
+                return True
+        elif value == alternative:
+            return True
+    return False
+
+
+def render_customers(customers):
+    return ''.join(
+        '<CustomerList>{}</CustomerList>'.format(''.join(
+            '<{0}>{1}</{0}>'.format(field, value)
+            for field, value in customer.items()
+        ))
+        for customer in customers
+    )
+
+
+def soap_response(operation, body):
+    return (200, {}, """
+<Soap:Envelope xmlns:Soap="http://schemas.xmlsoap.org/soap/envelope/">
+  <Soap:Body>
+    <{0}_Result xmlns="{1}">{2}</{0}_Result>
+  </Soap:Body>
+</Soap:Envelope>
+""".format(operation, PAGE_NS, body))
+
+
+def paged_request_callback(customers, request):
+    envelope = lxml.etree.fromstring(request.body)
+    ns = {'ns': PAGE_NS}
+    operation = lxml.etree.QName(
+        envelope.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')[0]
+    ).localname
+
+    if operation == 'Read':
+        no = envelope.findtext('.//ns:No', namespaces=ns)
+        return soap_response(
+            operation,
+            render_customers(c for c in customers if c['No'] == no),
+        )
+    elif operation == 'GetRecIdFromKey':
+        key = envelope.findtext('.//ns:Key', namespaces=ns)
+        no = next((c['No'] for c in customers if c['Key'] == key), None)
+        if no is None:
+            return (500, {}, FAULT_RESPONSE_DATA)
+        return soap_response(
+            operation,
+            '<GetRecIdFromKey_Result>Customer: {}</GetRecIdFromKey_Result>'.format(no),
+        )
+    elif operation == 'UpdateMultiple':
+        updated = []
+        for element in envelope.iterfind('.//ns:CustomerList', namespaces=ns):
+            fields = {
+                lxml.etree.QName(field).localname: field.text
+                for field in element
+            }
+            customer = next(
+                (c for c in customers if c['Key'] == fields['Key']),
+                None,
+            )
+            if customer is None:
+                # The entry was changed since it was read
+                return (500, {}, FAULT_RESPONSE_DATA)
+            customer.update(fields)
+            customer['Key'] += '+'
+            updated.append(customer)
+        return soap_response(
+            operation,
+            '<CustomerList_List>{}</CustomerList_List>'.format(
+                render_customers(updated)
+            ),
+        )
+    elif operation == 'Delete':
+        key = envelope.findtext('.//ns:Key', namespaces=ns)
+        keys = [c['Key'] for c in customers]
+        if key in keys:
+            del customers[keys.index(key)]
+        return soap_response(
+            operation,
+            '<Delete_Result>{}</Delete_Result>'.format(
+                'true' if key in keys else 'false'
+            ),
+        )
+    elif operation == 'ReadByRecId':
+        rec_id = envelope.findtext('.//ns:recId', namespaces=ns)
+        return soap_response(
+            operation,
+            render_customers(
+                c for c in customers if rec_id == 'Customer: ' + c['No']
+            ),
+        )
+
+    filters = [
+        (f.findtext('ns:Field', namespaces=ns), f.findtext('ns:Criteria', namespaces=ns))
+        for f in envelope.iterfind('.//ns:filter', namespaces=ns)
+    ]
+    set_size = int(envelope.findtext('.//ns:setSize', namespaces=ns))
+    bookmark_key = envelope.findtext('.//ns:bookmarkKey', namespaces=ns)
+
+    rows = [
+        c for c in customers
+        if all(
+            # Skip the placeholder filter sent when there are no filters
+            field not in c or matches_criteria(c[field], criteria)
+            for field, criteria in filters
+        )
+    ]
+    if bookmark_key is not None:
+        keys = [c['Key'] for c in rows]
+        rows = rows[keys.index(bookmark_key) + 1:]
+    if set_size:
+        rows = rows[:set_size]
+
+    return soap_response(
+        operation,
+        '<ReadMultiple_Result>{}</ReadMultiple_Result>'.format(
+            render_customers(rows)
+        ),
+    )
+
+
+class SharedCallGate:
+    """Hold back a response until other callers wait to share the call
+
+    Use as `customers` callback, with `call_class` in place of the single
+    flight calls that the sharing callers wait on. Only the first response is
+    held back.
+    """
+
+    def __init__(self, sharers):
+        self.sharers = sharers
+        waiting = self._waiting = threading.Semaphore(0)
+
+        class Done(threading.Event):
+            def wait(self, timeout=None):
+                waiting.release()
+                return super().wait(timeout)
+
+        class Call(nav.singleflight._Call):
+            def __init__(self):
+                super().__init__()
+                self.done = Done()
+
+        self.call_class = Call
+
+    def __call__(self, customers, request):
+        sharers, self.sharers = self.sharers, 0
+        for _ in range(sharers):
+            assert self._waiting.acquire(timeout=10)
+        return paged_request_callback(customers, request)
+
+
+@pytest.fixture
+def customers(request):
+    """Serve a page of customers that supports filters and paging
+
+    Parametrize indirectly to serve them with another callback, taking the
+    customers and the request like `paged_request_callback`.
+    """
+    callback = getattr(request, 'param', paged_request_callback)
+    customers = make_customers(7)
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add(
+            responses.GET,
+            re.compile(BASE_URL + 'Page/CustomerList'),
+            body=open(os.path.join(
+                os.path.dirname(__file__),
+                'wsdl/page-CustomerList.xml',
+            )).read(),
+            content_type='application/xml',
+        )
+        rsps.add_callback(
+            responses.POST,
+            re.compile(BASE_URL + 'Page/CustomerList'),
+            callback=lambda request: callback(customers, request),
+            content_type='application/xml'
+        )
+        yield customers
 
 
 @pytest.fixture
@@ -100,7 +348,7 @@ def add_responses():
             callback=dummy_request_callback,
             content_type='application/xml'
         )
-        yield
+        yield rsps
 
 
 @pytest.mark.usefixtures('add_responses')
@@ -227,6 +475,942 @@ def test_nav_class_create_multiple():
     assert data1 == data2
 
 
+def test_read_multiple_all_companies(add_responses):
+    company_url = 'http://navtest:7080/DynamicsNAV/WS/[^/]+/'
+    add_responses.add(
+        responses.GET,
+        re.compile(company_url + 'Page/CustomerList'),
+        body=open(os.path.join(
+            os.path.dirname(__file__),
+            'wsdl/page-CustomerList.xml',
+        )).read(),
+        content_type='application/xml',
+    )
+    add_responses.add_callback(
+        responses.POST,
+        re.compile(company_url + 'Page/.+'),
+        callback=dummy_request_callback,
+        content_type='application/xml'
+    )
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+
+    data = nv.read_multiple_all_companies(
+        'CustomerList',
+        ['Company A', 'Company B', 'Company C'],
+    )
+    assert list(data) == ['Company A', 'Company B', 'Company C']
+    assert all(rows[0]['No'] == '123' for rows in data.values())
+
+    # The WSDL is fetched once and shared between all companies
+    wsdl_calls = [c for c in add_responses.calls if c.request.method == 'GET']
+    assert len(wsdl_calls) == 1
+    post_urls = {
+        c.request.url for c in add_responses.calls
+        if c.request.method == 'POST'
+    }
+    assert post_urls == {
+        'http://navtest:7080/DynamicsNAV/WS/Company%20A/Page/CustomerList',
+        'http://navtest:7080/DynamicsNAV/WS/Company%20B/Page/CustomerList',
+        'http://navtest:7080/DynamicsNAV/WS/Company%20C/Page/CustomerList',
+    }
+
+
+@pytest.mark.usefixtures('add_responses')
+def test_compression_response():
+    nv = nav.NAV(BASE_URL, 'x', 'y', compression=nav.COMPRESSION_RESPONSE)
+
+    data = nv.read_multiple('CustomerList')
+    assert data[0]['No'] == '123'
+    assert nv.stats['requests'] == 1
+    assert nv.stats['request_bytes'] == nv.stats['request_wire_bytes']
+    assert 0 < nv.stats['response_wire_bytes'] < nv.stats['response_bytes']
+
+    uncompressed = nav.NAV(BASE_URL, 'x', 'y', compression=nav.COMPRESSION_OFF)
+    assert uncompressed.read_multiple('CustomerList') == data
+    assert uncompressed.stats['response_wire_bytes'] == (
+        uncompressed.stats['response_bytes']
+    )
+    assert nv.stats['response_wire_bytes'] < (
+        uncompressed.stats['response_wire_bytes']
+    )
+
+
+def test_compression_full(add_responses):
+    nv = nav.NAV(
+        BASE_URL,
+        'x',
+        'y',
+        compression=nav.COMPRESSION_FULL,
+        compress_min_size=1024,
+    )
+
+    nv.create_multiple('CustomerList', entries=[{'No': '1'}])
+    assert nv.stats['request_bytes'] == nv.stats['request_wire_bytes']
+
+    nv.create_multiple(
+        'CustomerList',
+        entries=[{'No': str(i), 'Name': 'Customer'} for i in range(100)],
+    )
+    assert nv.stats['requests'] == 2
+    assert nv.stats['request_wire_bytes'] < nv.stats['request_bytes']
+    assert add_responses.calls[-1].request.headers['Content-Encoding'] == 'gzip'
+
+
+def test_invalid_compression():
+    with pytest.raises(ValueError):
+        nav.NAV(BASE_URL, 'x', 'y', compression='brotli')
+
+
+def test_get_many(add_responses):
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+
+    result = nv.get_many('CustomerList', 'No', ['456', '999', 123])
+    assert list(result.found) == ['456', '123']
+    assert result.found['123']['Name'] == 'Customer #1'
+    assert result.missing == ['999']
+    posts = [c for c in add_responses.calls if c.request.method == 'POST']
+    assert len(posts) == 1
+    assert b'456|999|123' in posts[0].request.body
+
+    # `456|999` and `123`
+    nv.get_many('CustomerList', 'No', ['456', '999', 123], max_criteria_length=7)
+    posts = [c for c in add_responses.calls if c.request.method == 'POST']
+    assert len(posts) == 1 + 2
+
+
+def test_chunk_filter_criteria():
+    assert list(nav.utils.chunk_filter_criteria(['1', '2', '3'], 3)) == [
+        '1|2',
+        '3',
+    ]
+    assert list(nav.utils.chunk_filter_criteria(["A|B", "O'Neil", 'C'], 100)) == [
+        "'A|B'|'O''Neil'|C",
+    ]
+
+
+@pytest.mark.usefixtures('add_responses')
+def test_spooled_responses():
+    nv = nav.NAV(BASE_URL, 'x', 'y', spool_threshold=10)
+
+    data = nv.read_multiple('CustomerList')
+    assert data[1]['Name'] == 'Customer #2'
+    data = nv.create_multiple('CustomerList', entries=[{}])
+    assert data[0]['No'] == '234567'
+    data = nv.codeunit(
+        'IntegrationEntry',
+        'HelloWorld',
+        func_args=dict(iName='DISCARDED', oGreeting='TEST'),
+    )
+    assert data['oGreeting'] == 'Test greeting'
+    assert nv.stats['spooled_responses'] == 3
+
+
+def test_spooled_responses_checks():
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add(
+            responses.GET,
+            re.compile(BASE_URL + 'Page/CustomerList'),
+            body=open(os.path.join(
+                os.path.dirname(__file__),
+                'wsdl/page-CustomerList.xml',
+            )).read(),
+            content_type='application/xml',
+        )
+        rsps.add(
+            responses.POST,
+            re.compile(BASE_URL + 'Page/CustomerList'),
+            body='<!DOCTYPE x [<!ENTITY e "boom">]>' + PAGE_READMULTIPLE_RESPONSE_DATA,
+            content_type='application/xml',
+        )
+        rsps.add(
+            responses.POST,
+            re.compile(BASE_URL + 'Page/CustomerList'),
+            body='',
+            status=202,
+        )
+        nv = nav.NAV(BASE_URL, 'x', 'y', spool_threshold=10)
+
+        with pytest.raises(zeep.exceptions.EntitiesForbidden):
+            nv.read_multiple('CustomerList')
+        assert nv.read_multiple('CustomerList') == []
+
+
+@pytest.mark.usefixtures('add_responses')
+def test_max_response_size():
+    nv = nav.NAV(BASE_URL, 'x', 'y', max_response_size=10)
+
+    with pytest.raises(nav.exceptions.ResponseTooLarge):
+        nv.read_multiple('CustomerList')
+
+
+def test_nav_http_error_fault_text():
+    response = requests.Response()
+    response._content = FAULT_RESPONSE_DATA
+    exc = nav.exceptions.NAVHTTPError(response=response)
+    assert str(exc) == (
+        'a:Microsoft.Dynamics.Nav.Types.Exceptions.NavCSideException - '
+        'Customer No. must have a value'
+    )
+    assert nav.exceptions.fault_text(exc) == str(exc)
+
+    response._content = b'denied'
+    exc = nav.exceptions.NAVHTTPError(response=response)
+    assert nav.exceptions.fault_text(exc) == 'denied'
+
+
+@pytest.mark.usefixtures('add_responses')
+def test_schema_cache_dir(tmpdir):
+    nv = nav.NAV(
+        BASE_URL, 'x', 'y', schema_cache_dir=str(tmpdir), share_schemas=False,
+    )
+    data1 = nv.read_multiple('CustomerList')
+    assert nv.stats['schema_cache_misses'] == 1
+    assert len(tmpdir.listdir()) == 1
+
+    nv = nav.NAV(
+        BASE_URL, 'x', 'y', schema_cache_dir=str(tmpdir), share_schemas=False,
+    )
+    data2 = nv.read_multiple('CustomerList')
+    assert nv.stats['schema_cache_hits'] == 1
+    assert data1 == data2
+    data = nv.create_multiple('CustomerList', entries=[{'No': '1'}])
+    assert data[0]['No'] == '234567'
+
+    # Unusable artifacts are replaced
+    tmpdir.listdir()[0].write(b'garbage')
+    nv = nav.NAV(
+        BASE_URL, 'x', 'y', schema_cache_dir=str(tmpdir), share_schemas=False,
+    )
+    assert nv.read_multiple('CustomerList') == data1
+    assert nv.stats['schema_cache_misses'] == 1
+
+
+def test_shared_schemas(customers):
+    nv1 = nav.NAV(BASE_URL, 'x', 'y')
+    nv2 = nav.NAV(BASE_URL, 'z', 'w')
+    assert nv1.read_multiple('CustomerList') == nv2.read_multiple('CustomerList')
+    client1 = nv1._get_client(nav.PAGE, 'CustomerList')
+    client2 = nv2._get_client(nav.PAGE, 'CustomerList')
+    assert client1 is not client2
+    assert client1.wsdl is client2.wsdl
+    assert nv2.stats['schema_store_hits'] == 1
+
+    # Unshared definitions are parsed per instance
+    nv3 = nav.NAV(BASE_URL, 'x', 'y', share_schemas=False)
+    assert nv3._get_client(nav.PAGE, 'CustomerList').wsdl is not client1.wsdl
+    assert nv3.stats['schema_store_misses'] == 0
+
+
+def test_shared_schemas_meta():
+    wsdl = open(os.path.join(
+        os.path.dirname(__file__),
+        'wsdl/page-CustomerList.xml',
+    )).read()
+    other_url = 'http://othertenant:7080/DynamicsNAV/WS/Other/'
+    with responses.RequestsMock() as rsps:
+        for url in (BASE_URL, other_url):
+            rsps.add(
+                responses.GET,
+                re.compile(url + 'Page/CustomerList'),
+                body=wsdl,
+                content_type='application/xml',
+            )
+        nv1 = nav.NAV(BASE_URL, 'x', 'y', cache_expiration=0)
+        nv2 = nav.NAV(other_url, 'z', 'w', cache_expiration=0)
+        nv1.meta('Page', 'CustomerList')
+        num_calls = len(rsps.calls)
+        data = nv2.meta('Page', 'CustomerList')
+        assert b'ReadMultiple' in lxml.etree.tostring(data)
+
+        # The second tenant only contacts its own host
+        urls = [c.request.url for c in rsps.calls[num_calls:]]
+        assert urls
+        assert all(url.startswith(other_url) for url in urls)
+
+        # Shared documents carry neither tenant's credentials nor location
+        client1 = nv1._get_client(nav.PAGE, 'CustomerList')
+        client2 = nv2._get_client(nav.PAGE, 'CustomerList')
+        assert client1.wsdl is client2.wsdl
+        assert client2.wsdl.transport.session.auth is None
+        assert client2.wsdl.transport.session is not nv1._session
+        assert client2.wsdl.location is None
+        assert client2.transport.session.auth.username == 'z'
+
+
+def test_schema_store_eviction():
+    store = nav.store.SchemaStore(max_bytes=10)
+    settings = zeep.Settings(strict=False)
+    key1, doc1, held = store.acquire(b'123456', settings, object)
+    assert not held
+    assert store.acquire(b'123456', settings, object)[1:] == (doc1, True)
+    key2, doc2, _ = store.acquire(b'abcdef', settings, object)
+    # Documents in use are kept, even when over the limit
+    assert len(store) == 2
+    assert store.size == 12
+
+    store.release(key1)
+    assert len(store) == 2
+    store.release(key1)
+    assert len(store) == 1
+    assert store.acquire(b'abcdef', settings, object)[1:] == (doc2, True)
+
+    # Released once the owner is garbage collected
+    class Owner:
+        pass
+
+    owner = Owner()
+    store.bind(owner, key2)
+    store.bind(owner, key2)
+    store.max_bytes = 0
+    del owner
+    assert len(store) == 0
+
+
+@pytest.mark.usefixtures('add_responses')
+def test_create_multiple_bisect():
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+    entries = [{'No': str(i)} for i in range(8)]
+    entries[2]['Name'] = 'INVALID'
+    entries[5]['Name'] = 'INVALID'
+
+    with pytest.raises(zeep.exceptions.Fault):
+        nv.create_multiple('CustomerList', entries=entries)
+
+    report = nv.create_multiple('CustomerList', entries=entries, on_error='bisect')
+    assert [failed.index for failed in report.failed] == [2, 5]
+    assert report.failed[0].entry == entries[2]
+    assert report.failed[0].error == (
+        'a:Microsoft.Dynamics.Nav.Types.Exceptions.NavCSideException - '
+        'Customer No. must have a value'
+    )
+    # The stub returns two entries per successful request:
+    # [0, 1], [3], [4], [6, 7]
+    assert len(report.created) == 4 * 2
+
+
+def test_create_multiple_bisect_http_error():
+    with responses.RequestsMock() as rsps:
+        rsps.add(
+            responses.GET,
+            re.compile(BASE_URL + 'Page/CustomerList'),
+            body='denied',
+            status=401,
+        )
+        nv = nav.NAV(BASE_URL, 'x', 'y', cache_expiration=0)
+        with pytest.raises(nav.exceptions.NAVHTTPError):
+            nv.create_multiple(
+                'CustomerList',
+                entries=[{'No': str(i)} for i in range(8)],
+                on_error='bisect',
+            )
+        assert len(rsps.calls) == 1
+
+
+@pytest.mark.skipif(not nav.decoding.SUPPORTED, reason='Requires Python 3.7+')
+@pytest.mark.usefixtures('add_responses')
+def test_decode_workers():
+    nv = nav.NAV(BASE_URL, 'x', 'y', decode_workers=2)
+    try:
+        data = nv.read_multiple('CustomerList')
+        assert data == nav.NAV(BASE_URL, 'x', 'y').read_multiple('CustomerList')
+        for _ in range(4):
+            assert nv.read_multiple('CustomerList') == data
+        # The definitions are sent to each worker at most once
+        assert 1 <= nv.stats['worker_schema_transfers'] <= 2
+        data = nv.codeunit(
+            'IntegrationEntry',
+            'HelloWorld',
+            func_args=dict(iName='DISCARDED', oGreeting='TEST'),
+        )
+        assert data['oGreeting'] == 'Test greeting'
+        assert nv.stats['worker_decoded_responses'] == 6
+
+        # Faults are still raised
+        with pytest.raises(zeep.exceptions.Fault):
+            nv.create_multiple('CustomerList', entries=[{'Name': 'INVALID'}])
+    finally:
+        nv.close()
+
+
+def test_decode_workers_unsupported(monkeypatch):
+    monkeypatch.setattr(nav.decoding, 'SUPPORTED', False)
+    with pytest.warns(RuntimeWarning):
+        nv = nav.NAV(BASE_URL, 'x', 'y', decode_workers=2)
+    assert nv._decode_pool is None
+
+
+def test_cassette_record_and_replay(tmpdir):
+    path = str(tmpdir.join('cassette.jsonl.gz'))
+    func_args = dict(iName='DISCARDED', oGreeting='TEST')
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add_callback(
+            responses.GET,
+            re.compile(BASE_URL + '.+'),
+            callback=lambda request: (
+                200,
+                {'Set-Cookie': 'secret'},
+                open(os.path.join(
+                    os.path.dirname(__file__),
+                    'wsdl/page-CustomerList.xml'
+                    if '/Page/' in request.url else
+                    'wsdl/codeunit-IntegrationEntry.xml',
+                )).read(),
+            ),
+        )
+        rsps.add_callback(
+            responses.POST,
+            re.compile(BASE_URL + '.+'),
+            callback=dummy_request_callback,
+        )
+        nv = nav.NAV(BASE_URL, 'x', 'y', cassette=path, cassette_mode='record')
+        recorded_page = nv.read_multiple('CustomerList')
+        recorded_codeunit = nv.codeunit('IntegrationEntry', 'HelloWorld', func_args)
+
+    with gzip.open(path) as f:
+        cassette = f.read()
+    assert b'navtest' not in cassette
+    assert b'secret' not in cassette
+
+    # No stub server is running, so everything is served from the cassette
+    nv = nav.NAV(BASE_URL, 'x', 'y', cassette=path, cassette_mode='replay')
+    assert nv.read_multiple('CustomerList') == recorded_page
+    assert nv.codeunit('IntegrationEntry', 'HelloWorld', func_args) == recorded_codeunit
+
+    with pytest.raises(nav.exceptions.InteractionNotRecorded):
+        nv.create_multiple('CustomerList', entries=[{}])
+    # Requests with other arguments are not served another request's response
+    with pytest.raises(nav.exceptions.InteractionNotRecorded):
+        nv.read_multiple('CustomerList', filters={'No': '123'})
+
+    nv = nav.NAV(
+        BASE_URL, 'x', 'y',
+        cassette=path, cassette_mode='replay', replay_fallback=True,
+    )
+    assert nv.read_multiple('CustomerList', filters={'No': '123'}) == recorded_page
+
+
+@pytest.mark.usefixtures('add_responses')
+def test_gateway_server():
+    server = nav.server.GatewayServer(
+        ('127.0.0.1', 0),
+        {'nav': nav.NAV(BASE_URL, 'x', 'y')},
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    daemon_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        data = nav.server.forward(
+            'page',
+            daemon_url=daemon_url,
+            service_name='CustomerList',
+            function=nav.ReadMultiple,
+            filters={'No': '123|456'},
+        )
+        assert [entry['No'] for entry in data] == ['123', '456']
+
+        data = nav.server.forward(
+            'codeunit',
+            daemon_url=daemon_url,
+            service_name='IntegrationEntry',
+            function='HelloWorld',
+            func_args=dict(iName='DISCARDED', oGreeting='TEST'),
+        )
+        assert data['oGreeting'] == 'Test greeting'
+
+        with pytest.raises(nav.exceptions.GatewayError) as excinfo:
+            nav.server.forward(
+                'page',
+                daemon_url=daemon_url,
+                service_name='CustomerList',
+                function=nav.CreateMultiple,
+                entries=[{'Name': 'INVALID'}],
+            )
+        assert 'Customer No. must have a value' in str(excinfo.value)
+
+        with pytest.raises(nav.exceptions.GatewayError):
+            nav.server.forward(
+                'page',
+                daemon_url=daemon_url,
+                config_section='missing',
+                service_name='CustomerList',
+                function=nav.ReadMultiple,
+            )
+
+        # Web pages can't make calls, neither directly nor by DNS rebinding
+        for headers, status in [
+            ({'Content-Type': 'text/plain'}, 415),
+            ({'Origin': 'http://evil.example'}, 403),
+            ({'Host': 'evil.example:7047'}, 403),
+        ]:
+            request = urllib.request.Request(
+                daemon_url + '/page',
+                data=json.dumps({
+                    'service_name': 'CustomerList',
+                    'function': nav.CreateMultiple,
+                    'entries': [{'Name': 'Evil'}],
+                }).encode(),
+                headers=dict({'Content-Type': 'application/json'}, **headers),
+            )
+            with pytest.raises(urllib.error.HTTPError) as excinfo:
+                urllib.request.urlopen(request)
+            assert excinfo.value.code == status
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='Requires Unix sockets')
+@pytest.mark.usefixtures('add_responses')
+def test_gateway_server_unix_socket(tmpdir):
+    path = str(tmpdir.join('nav.sock'))
+    server = nav.server.UnixGatewayServer(path, {'nav': nav.NAV(BASE_URL, 'x', 'y')})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        data = nav.server.forward(
+            'read_multiple',
+            daemon_url='unix:' + path,
+            service_name='CustomerList',
+        )
+        assert [entry['No'] for entry in data] == ['123', '456']
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not os.path.exists(path)
+
+
+def test_via_daemon_options():
+    with pytest.raises(argh.CommandError):
+        nav.__main__.page('CustomerList', nav.ReadMultiple, username='x', via_daemon=True)
+
+
+def test_iter_read_multiple(customers):
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+
+    entries = list(nv.iter_read_multiple('CustomerList', page_size=3))
+    assert [e['No'] for e in entries] == [c['No'] for c in customers]
+    assert nv.stats['requests'] == 3
+
+    entries = list(nv.iter_read_multiple(
+        'CustomerList',
+        filters={'No': 'C02..C04'},
+        page_size=3,
+    ))
+    assert [e['No'] for e in entries] == ['C02', 'C03', 'C04']
+
+
+def test_batch(customers, tmpdir):
+    jobs = nav.batch.parse_jobs([
+        {
+            'id': 'all',
+            'type': 'Page',
+            'service': 'CustomerList',
+            'function': 'ReadMultiple',
+            'page_size': 3,
+        },
+        {
+            'id': 'some',
+            'type': 'Page',
+            'service': 'CustomerList',
+            'function': 'ReadMultiple',
+            'filters': {'No': 'C02..C03'},
+            'depends_on': ['all'],
+        },
+        {
+            'id': 'broken',
+            'type': 'Page',
+            'service': 'Unknown',
+            'function': 'ReadMultiple',
+        },
+        {
+            'id': 'after_broken',
+            'type': 'Page',
+            'service': 'CustomerList',
+            'function': 'ReadMultiple',
+            'depends_on': ['broken'],
+        },
+    ])
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+    results = nav.batch.run(nv, jobs, str(tmpdir), max_workers=2)
+
+    assert [(r.id, r.status, r.entries) for r in results] == [
+        ('all', 'ok', 7),
+        ('some', 'ok', 2),
+        ('broken', 'failed', 0),
+        ('after_broken', 'skipped', 0),
+    ]
+    with open(str(tmpdir.join('all.json'))) as f:
+        assert [e['No'] for e in json.load(f)] == [c['No'] for c in customers]
+    with open(str(tmpdir.join('some.json'))) as f:
+        assert [e['No'] for e in json.load(f)] == ['C02', 'C03']
+    assert not tmpdir.join('after_broken.json').exists()
+    assert '4 jobs, 1 failed, 1 skipped' in nav.batch.format_summary(results, 1)
+
+    for invalid in (
+        [{'id': 'a', 'type': 'Page', 'service': 'X', 'function': 'Y', 'depends_on': ['b']}],
+        [
+            {'id': 'a', 'type': 'Page', 'service': 'X', 'function': 'Y', 'depends_on': ['b']},
+            {'id': 'b', 'type': 'Page', 'service': 'X', 'function': 'Y', 'depends_on': ['a']},
+        ],
+        [{'id': 'a', 'type': 'Report', 'service': 'X', 'function': 'Y'}],
+    ):
+        with pytest.raises(nav.exceptions.InvalidBatchJobs):
+            nav.batch.parse_jobs(invalid)
+
+
+def test_read(customers):
+    clock = [0]
+    nv = nav.NAV(BASE_URL, 'x', 'y', identity_map_size=2)
+    nv._records._clock = nv._record_keys._clock = lambda: clock[0]
+
+    def posts():
+        return nv.stats['requests']
+
+    entry = nv.read('CustomerList', {'No': 'C02'})
+    assert entry['Key'] == 'KEY2'
+    assert entry['Name'] == 'Customer #2'
+    assert posts() == 1
+    entry['Name'] = 'Changed'
+    assert nv.read('CustomerList', {'No': 'C02'})['Name'] == 'Customer #2'
+    assert nv.read_by_key('CustomerList', 'KEY2')['No'] == 'C02'
+    assert posts() == 1
+    assert nv.stats['identity_map_hits'] == 2
+
+    assert nv.read('CustomerList', {'No': 'C99'}) is None
+    assert posts() == 2
+
+    entry = nv.read_by_key('CustomerList', 'KEY5')
+    assert entry['No'] == 'C05'
+    assert posts() == 4
+    nv.read_by_key('CustomerList', 'KEY5')
+    assert posts() == 4
+
+    with pytest.raises(zeep.exceptions.Fault):
+        nv.read_by_key('CustomerList', 'MISSING')
+    assert posts() == 5
+
+    # Only two entries are kept, C02 is the least recently used
+    nv.read('CustomerList', {'No': 'C03'})
+    nv.read('CustomerList', {'No': 'C02'})
+    assert posts() == 7
+
+    # Entries expire
+    clock[0] += nav.constants.DEFAULT_IDENTITY_MAP_TTL
+    nv.read('CustomerList', {'No': 'C02'})
+    assert posts() == 8
+
+
+def test_envelope_cache(customers):
+    nv = nav.NAV(BASE_URL, 'x', 'y', envelope_cache_size=8)
+    first = nv.read_multiple('CustomerList', filters={'No': 'C02..C03'})
+    second = nv.read_multiple('CustomerList', filters={'No': 'C02..C03'})
+    assert first == second
+    assert [e['No'] for e in first] == ['C02', 'C03']
+    nv.read_multiple('CustomerList')
+    nv.read_multiple('CustomerList')
+    assert nv.stats['envelope_cache_misses'] == 2
+    assert nv.stats['envelope_cache_hits'] == 2
+
+    prepared = nv.prepare('CustomerList', 'ReadMultiple', num_results=2)
+    assert b'<ns0:setSize>2</ns0:setSize>' in prepared.message
+    assert [e['No'] for e in prepared.execute()] == ['C01', 'C02']
+    assert prepared.execute() == prepared.execute()
+
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+    assert nv.read('CustomerList', {'No': 'C01'})['Name'] == 'Customer #1'
+    assert nv.prepare(
+        'CustomerList',
+        'Read',
+        additional_data={'No': 'C04'},
+    ).execute()['Name'] == 'Customer #4'
+    assert 'envelope_cache_hits' not in nv.stats.as_dict()
+
+
+def test_update_multiple_and_delete(customers):
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+    assert nv.read('CustomerList', {'No': 'C02'})['Name'] == 'Customer #2'
+
+    updated = nv.update_multiple(
+        'CustomerList',
+        [
+            {'Key': 'KEY2', 'Name': 'Renamed #2'},
+            {'Key': 'KEY3', 'Name': 'Renamed #3'},
+            {'Key': 'KEY4', 'Name': 'Renamed #4'},
+        ],
+        batch_size=2,
+    )
+    assert nv.stats['requests'] == 3
+    assert [(e['No'], e['Key'], e['Name']) for e in updated] == [
+        ('C02', 'KEY2+', 'Renamed #2'),
+        ('C03', 'KEY3+', 'Renamed #3'),
+        ('C04', 'KEY4+', 'Renamed #4'),
+    ]
+    assert nv.read('CustomerList', {'No': 'C02'})['Name'] == 'Renamed #2'
+    assert nv.stats['requests'] == 4
+    assert nv.read_by_key('CustomerList', 'KEY3+')['Name'] == 'Renamed #3'
+    assert nv.stats['requests'] == 4
+
+    # The entry has changed since it was read with this key
+    with pytest.raises(zeep.exceptions.Fault):
+        nv.update_multiple('CustomerList', [{'Key': 'KEY2', 'Name': 'Stale'}])
+    with pytest.raises(ValueError):
+        nv.update_multiple('CustomerList', [{'No': 'C02', 'Name': 'No key'}])
+    with pytest.raises(ValueError):
+        nv.update_multiple('CustomerList', updated, on_error='bisect')
+
+    # The batches that NAV committed are reported along with the failed one
+    report = nv.update_multiple(
+        'CustomerList',
+        [
+            {'Key': 'KEY3+', 'Name': 'Again #3'},
+            {'Key': 'KEY2', 'Name': 'Stale'},
+            {'Key': 'KEY4+', 'Name': 'Again #4'},
+        ],
+        batch_size=1,
+        on_error='report',
+    )
+    assert [e and e['Name'] for e in report.updated] == ['Again #3', None, 'Again #4']
+    assert [(f.index, f.entry['Key']) for f in report.failed] == [(1, 'KEY2')]
+    assert report.failed[0].error
+
+    assert nv.delete('CustomerList', ['KEY5', updated[0], 'KEY99']) == [
+        True,
+        True,
+        False,
+    ]
+    report = nv.delete('CustomerList', ['KEY6', 'KEY99'], on_error='report')
+    assert report == nav.DeleteReport(deleted=[True, False], failed=[])
+    assert [c['No'] for c in customers] == ['C01', 'C03', 'C04', 'C07']
+    assert nv.read_by_key('CustomerList', 'KEY3++') is not None
+    assert nv._records.get((nv._cache_scope, 'CustomerList', 'KEY2+')) is None
+
+
+def test_iter_read_multiple_prefetch(customers):
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+
+    entries = list(nv.iter_read_multiple('CustomerList', page_size=2, prefetch=2))
+    assert [e['No'] for e in entries] == [c['No'] for c in customers]
+    assert nv.stats['requests'] == 4
+
+    # Stopping early stops the background requests too
+    entries = nv.iter_read_multiple('CustomerList', page_size=1, prefetch=1)
+    assert next(entries)['No'] == 'C01'
+    entries.close()
+    assert 'nav-prefetch' not in [t.name for t in threading.enumerate()]
+    assert nv.stats['requests'] <= 4 + 3
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        list(nv.iter_read_multiple('Unknown', prefetch=1))
+
+
+def test_profile(customers, capsys):
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+    with nav.profiling.Profile() as profile:
+        nv.read_multiple('CustomerList')
+    for phase in ('wsdl_load', 'server_wait', 'parse', 'conversion'):
+        assert profile.phases[phase] > 0
+    assert profile.peak_memory > 0
+    assert not nav.profiling.is_active()
+    assert 'conversion' in profile.report()
+
+    nav.__main__.page(
+        'CustomerList',
+        'ReadMultiple',
+        base_url=BASE_URL,
+        username='x',
+        password='y',
+        num_results=1,
+        profile=True,
+    )
+    out, err = capsys.readouterr()
+    assert json.loads(out)[0]['No'] == 'C01'
+    assert 'server_wait' in err
+    assert 'Peak memory' in err
+
+
+def test_namespace_rewrite_plugin():
+    envelope = lxml.etree.fromstring(''.join([
+        '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+        '<soap:Body><a:Root xmlns:a="urn:a" xmlns:b="urn:b" xmlns:c="urn:c">',
+        '<a:Line><b:No>1</b:No><c:Kept>x</c:Kept></a:Line>' * 3,
+        '</a:Root></soap:Body></soap:Envelope>',
+    ]))
+    plugin = nav.NamespaceRewritePlugin({'urn:a': None, 'urn:b': 'urn:new'}, ingress=True)
+    envelope, _ = plugin.egress(envelope, {}, None, None)
+    root = envelope[0][0]
+    assert root.tag == 'Root'
+    assert [e.tag for e in root[0]] == ['{urn:new}No', '{urn:c}Kept']
+    assert 'urn:a' not in lxml.etree.tostring(envelope).decode()
+    assert len(root.findall('Line')) == 3
+
+    envelope, _ = plugin.ingress(envelope, {}, None)
+    assert root.tag == '{urn:a}Root'
+    assert [e.tag for e in root[0]] == ['{urn:b}No', '{urn:c}Kept']
+    assert envelope.tag == '{http://schemas.xmlsoap.org/soap/envelope/}Envelope'
+
+    # Faults are left alone, even when unqualified elements are rewritten
+    fault, _ = plugin.ingress(lxml.etree.fromstring(FAULT_RESPONSE_DATA), {}, None)
+    assert fault.find('.//faultcode') is not None
+    assert fault.find('.//faultstring').text == 'Customer No. must have a value'
+
+    with pytest.raises(ValueError):
+        nav.NamespaceRewritePlugin(['urn:a', 'urn:b'], ingress=True)
+
+    # Nothing to rewrite
+    plugin = nav.NamespaceRewritePlugin([], ingress=True)
+    assert plugin.egress(envelope, {}, None, None)[0] is envelope
+    assert plugin.ingress(envelope, {}, None)[0] is envelope
+    assert root.tag == '{urn:a}Root'
+
+    plugin = nav.RemoveNamespacePlugin('urn:c')
+    assert plugin.namespace == 'urn:c'
+    envelope, _ = plugin.egress(envelope, {}, None, None)
+    assert [e.tag for e in root[0]] == ['{urn:b}No', 'Kept']
+    # Responses are left alone unless asked for
+    envelope, _ = plugin.ingress(envelope, {}, None)
+    assert [e.tag for e in root[0]] == ['{urn:b}No', 'Kept']
+
+
+SINGLE_FLIGHT_GATE = SharedCallGate(sharers=4)
+
+
+@pytest.mark.parametrize('customers', [SINGLE_FLIGHT_GATE], indirect=True)
+def test_single_flight(customers, monkeypatch):
+    monkeypatch.setattr(nav.singleflight, '_Call', SINGLE_FLIGHT_GATE.call_class)
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+    nv.make_service('Page', 'CustomerList')
+
+    def posts():
+        return nv.stats['requests']
+
+    results = []
+
+    def read():
+        results.append(nv.read_multiple('CustomerList', filters={'Blocked': 'false'}))
+
+    threads = [threading.Thread(target=read) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert posts() == 1
+    assert nv.stats['single_flight_shared'] == 4
+    assert all(r == results[0] for r in results)
+    assert [e['No'] for e in results[0]] == ['C02', 'C04', 'C06']
+    results[0][0]['Name'] = 'Changed'
+    assert results[1][0]['Name'] != 'Changed'
+
+    # Calls are deduplicated only while in flight
+    nv.read_multiple('CustomerList', filters={'Blocked': 'false'})
+    assert posts() == 2
+
+    # Functions not opted in are never shared
+    nv.single_flight_functions = frozenset()
+    nv.read_multiple('CustomerList')
+    assert posts() == 3
+
+
+def test_decode_policy(customers):
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+    entry = nv.read_multiple('CustomerList')[0]
+    assert entry['Balance_LCY'] == decimal.Decimal('100.50')
+    assert entry['Last_Date_Modified'] == datetime.date(2019, 1, 1)
+
+    nv = nav.NAV(
+        BASE_URL,
+        'x',
+        'y',
+        decode_policy={'decimal': 'float', 'dates': 'iso'},
+    )
+    entry = nv.read_multiple('CustomerList')[0]
+    assert entry['Balance_LCY'] == 100.5
+    assert entry['Last_Date_Modified'] == '2019-01-01'
+    assert entry['Blocked'] is True
+    assert json.loads(json.dumps(entry)) == entry
+
+    nv.decode_policy = {'decimal': 'str'}
+    entry = nv.read_multiple('CustomerList')[0]
+    assert entry['Balance_LCY'] == '100.50'
+    assert entry['Last_Date_Modified'] == datetime.date(2019, 1, 1)
+
+    with pytest.raises(ValueError):
+        nav.NAV(BASE_URL, 'x', 'y', decode_policy={'decimal': 'int'})
+    with pytest.raises(ValueError):
+        nav.NAV(BASE_URL, 'x', 'y', decode_policy={'booleans': 'str'})
+
+
+def test_mirror(customers, tmpdir):
+    db_path = str(tmpdir.join('mirror.db'))
+    customers[1]['Balance_LCY'] = '12345678901234567.89'
+    nv = nav.NAV(BASE_URL, 'x', 'y')
+
+    mirror = nv.mirror(
+        'CustomerList',
+        db_path,
+        index_fields=['Name'],
+        key_fields=['No'],
+        since_field='Last_Date_Modified',
+        page_size=3,
+    )
+    requests_made = nv.stats['requests']
+
+    def numbers(filters, **kw):
+        return [e['No'] for e in mirror.query(filters, order_by=['No'], **kw)]
+
+    assert numbers({}) == [c['No'] for c in customers]
+    assert numbers({'No': 'C02|C05'}) == ['C02', 'C05']
+    assert numbers({'No': 'C02..C04&<>C03'}) == ['C02', 'C04']
+    assert numbers({'No': '..C02|C07..'}) == ['C01', 'C02', 'C07']
+    assert numbers({'Name': '*#3'}) == ['C03']
+    assert numbers({'Name': '@customer #?'}, limit=2) == ['C01', 'C02']
+    assert numbers({'Balance_LCY': '>=500'}) == ['C02', 'C05', 'C06', 'C07']
+    assert numbers({'Balance_LCY': '100.5|300.50..400.5'}) == ['C01', 'C03', 'C04']
+    assert numbers({'Blocked': 'No', 'No': '<C05'}) == ['C02', 'C04']
+    assert numbers({'Name': "'Customer #1'"}) == ['C01']
+    assert numbers({'Name': "'Customer *'"}) == []
+    assert [e['No'] for e in mirror.query(order_by=['Balance_LCY'])][-2:] == [
+        'C07', 'C02',
+    ]
+    assert nv.stats['requests'] == requests_made
+
+    entry = mirror.query({'No': 'C01'})[0]
+    assert str(entry['Balance_LCY']) == '100.50'
+    assert entry['Blocked'] is True
+    assert entry['Last_Date_Modified'] == datetime.date(2019, 1, 1)
+    entry = mirror.query({'No': 'C02'})[0]
+    assert entry['Balance_LCY'] == decimal.Decimal('12345678901234567.89')
+
+    with pytest.raises(ValueError):
+        mirror.query({'Unknown': '1'})
+
+    # Only entries modified on or after the latest date are read again
+    customers[0]['Last_Date_Modified'] = '2019-02-01'
+    customers[0]['Name'] = 'Renamed'
+    result = mirror.refresh()
+    assert result == {'entries': 2, 'incremental': True}
+    assert numbers({'Name': 'Renamed'}) == ['C01']
+    assert len(mirror.query()) == len(customers)
+
+    assert mirror.refresh(full=True) == {'entries': 7, 'incremental': False}
+    mirror.close()
+
+
+@pytest.mark.parametrize('kind,value', [
+    ('date', datetime.date(2019, 5, 6)),
+    ('datetime', datetime.datetime(2019, 5, 6, 7, 8, 9, 10)),
+    ('datetime', datetime.datetime(
+        2019, 5, 6, 7, 8, 9,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=2)),
+    )),
+    ('time', datetime.time(7, 8, 9, tzinfo=datetime.timezone.utc)),
+])
+def test_mirror_parse_iso(kind, value):
+    assert nav.mirror._parse_iso(kind, value.isoformat()) == value
+
+
 def test_entry_point_runnable():
     proc = subp.run(['nav'], stdout=subp.PIPE)
-    assert b'{interact,meta,codeunit,page}' in proc.stdout
+    assert b'{interact,meta,codeunit,page,mirror,serve,batch}' in proc.stdout